@@ -1,242 +1,429 @@
-from hashlib import md5
 from json import dumps, loads
 from json.decoder import JSONDecodeError
-from logging import debug, info, warning
+from logging import DEBUG, debug, getLogger, info, warning
 from os import makedirs
-from os.path import expanduser, expandvars, getsize, isdir, isfile, join
-from re import match
-from shutil import copyfile, move
-from tempfile import gettempdir, mkstemp
-from traceback import print_exc
-from urllib.parse import unquote_plus
+from os.path import expanduser, expandvars, isdir, isfile, join
+from tempfile import gettempdir
+from time import perf_counter
+from urllib.parse import parse_qsl, unquote_plus
 from uuid import uuid4
 
-from PIL import Image
-from PIL.Image import Resampling
-from twisted.internet import reactor
 from twisted.internet.address import IPv4Address
-from twisted.internet.error import CannotListenError
-from twisted.internet.protocol import Factory
+from twisted.internet.defer import gatherResults, maybeDeferred
+from twisted.web.http import CACHED
 from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
 
 from konnect import __version__
 from konnect.exceptions import ApiError, DeviceNotReachableError, DeviceNotTrustedError, NotImplementedError2, \
   UnserializationError
-from konnect.protocols import MAX_TCP_PORT, MIN_TCP_PORT, ShareSend
-
-
-MIN_XFER_PORT = MIN_TCP_PORT + 1
-MAX_XFER_PORT = MAX_TCP_PORT - 1
-
-MAX_ICON_SIZE = 96
-CHECKS = {
-  # (method, resource): (trusted, reacheable, key)
-  ("POST", "pair"): (False, True, False),
-  ("DELETE", "pair"): (True, False, False),
-  ("GET", "device"): (True, False, False),
-  ("POST", "ping"): (True, True, False),
-  ("POST", "ring"): (True, True, False),
-  ("POST", "notification"): (True, False),
-  ("DELETE", "notification"): (True, False, True),
-  ("GET", "command"): (True, False, False),
-  ("POST", "command"): (True, False, False),
-  ("PUT", "command"): (True, False, True),
-  ("DELETE", "command"): (True, False, True),
-  ("PATCH", "command"): (True, True, True),
-  ("PATCH", "share"): (True, False, False),
-  ("POST", "custom"): (True, True, False),
+from konnect.factories import normalizeName
+from konnect.icons import IconProcessor
+from konnect.logs import DEVICE, ROUTE, TRACE_DURATION, TRACE_RATE, TRACE_SAMPLE
+from konnect.metrics import LATENCY, REQUESTS, renderMetrics
+from konnect.monitor import Profiler
+from konnect.packet import encode
+
+
+STATIC_ROUTES = {
+  # (method, path): handler
+  ("GET", "/"): "_handleInfo",
+  ("PUT", "/"): "_handleAnnounce",
+  ("GET", "/device"): "_handleDevices",
+  ("GET", "/command"): "_handleCommands",
+  ("GET", "/notification"): "_handleNotifications",
+  ("POST", "/notification"): "_handleBatchNotifications",
+  ("GET", "/version"): "_handleVersion",
+  ("GET", "/database"): "_handleDatabase",
+  ("GET", "/trace"): "_handleTraces",
+  ("PUT", "/trace"): "_handleEnableRouteTrace",
+  ("DELETE", "/trace"): "_handleDisableRouteTrace",
+  ("PUT", "/profile"): "_handleStartProfile",
+  ("DELETE", "/profile"): "_handleStopProfile",
+  ("GET", "/memory"): "_handleGetMemory",
+  ("PUT", "/memory"): "_handleStartMemory",
+  ("DELETE", "/memory"): "_handleStopMemory",
 }
+DEVICE_ROUTES = {
+  # (method, resource): (handler, trusted, reacheable, key)
+  ("GET", "device"): ("_handleGetDevice", True, False, False),
+  ("POST", "pair"): ("_handlePair", False, True, False),
+  ("DELETE", "pair"): ("_handleUnpair", True, False, False),
+  ("POST", "ping"): ("_handlePing", True, True, False),
+  ("POST", "ring"): ("_handleRing", True, True, False),
+  ("POST", "notification"): ("_handleCreateNotification", True, False, False),
+  ("DELETE", "notification"): ("_handleDeleteNotification", True, False, True),
+  ("GET", "command"): ("_handleListCommands", True, False, False),
+  ("POST", "command"): ("_handleCreateCommand", True, False, False),
+  ("PUT", "command"): ("_handleUpdateCommand", True, False, True),
+  ("DELETE", "command"): ("_handleDeleteCommand", True, False, True),
+  ("PATCH", "command"): ("_handleExecuteCommand", True, True, True),
+  ("PATCH", "share"): ("_handleUpdateShare", True, False, False),
+  ("POST", "custom"): ("_handleCustomPacket", True, True, False),
+  ("PUT", "trace"): ("_handleEnableDeviceTrace", False, False, False),
+  ("DELETE", "trace"): ("_handleDisableDeviceTrace", False, False, False),
+}
+ROUTES = {resource for _, resource in DEVICE_ROUTES} | {path[1:] for _, path in STATIC_ROUTES} | {"metrics"}
 
 
 class API(Resource):
   isLeaf = True
-  PATTERN = r"^\/(?P<res>[a-z]+)\/(?P<dev>@?.+?)((?:\/)(?P<key>=?.+?))?$"
 
-  def __init__(self, konnect, discovery, database, debug):
+  def __init__(self, konnect, discovery, transfers, database, debug):
     super().__init__()
     self.konnect = konnect
     self.discovery = discovery
+    self.transfers = transfers
     self.database = database
     self.debug = debug
-    self.listeners = {}
 
     self.temp_dir = join(gettempdir(), "konnect_" + konnect.name)
     makedirs(self.temp_dir, exist_ok=True)
+    self.icons = IconProcessor(self.temp_dir)
+    self.profiler = Profiler()
+
+    # bound once, dispatch is a dict lookup however many routes there are
+    self.routes = {route: getattr(self, handler) for route, handler in STATIC_ROUTES.items()}
+    self.resources = {route: (getattr(self, handler), *checks) for route, (handler, *checks) in DEVICE_ROUTES.items()}
+
+    # collections polled by dashboards, answered from their version without reading sqlite or encoding again
+    self.epoch = uuid4().hex[:8]  # versions restart with the process
+    self.versions = {"/device": lambda: self.konnect.version, "/notification": lambda: self.database.committed,
+                     "/command": lambda: self.database.committed}
+    self.bodies = {}  # uri: (etag, body) of the last response
+
+  def _getDeviceId(self, item, known=True):  # unknown identifiers are kept when known is false
+    if item[0] != "@":
+      identifier = unquote_plus(item)
 
-  def _getDeviceId(self, item):
-    key = "name" if item[0] == "@" else "identifier"
-    value = unquote_plus(item[1:] if key == "name" else item)
+      if not known or self.konnect.findClient(identifier) or self.database.isDeviceTrusted(identifier):
+        return identifier
 
-    for device in self.konnect.getDevices().values():
-      if device[key] == value:
+      return None
+
+    name = unquote_plus(item[1:])
+
+    if client := self.konnect.findClientByName(name):
+      return client.identifier
+
+    for device in self.konnect.getDevices():  # offline devices only
+      if normalizeName(device["name"]) == normalizeName(name):
         return device["identifier"]
 
     return None
 
   def render(self, request):
-    request.setHeader(b"content-type", b"application/json")
+    start = perf_counter()
     uri = request.uri.decode()
     method = request.method.decode()
+
+    if request.path == b"/metrics" and method == "GET":  # plain text exposition format, skips the json handling
+      request.setHeader(b"content-type", b"text/plain; version=0.0.4")
+      self._recordRequest(uri, 200, start)
+      return renderMetrics(self.database.collectMetrics)
+
+    request.setHeader(b"content-type", b"application/json")
     content = request.content.read().decode() if request.getHeader("content-length") else "{}"
 
-    debug(f"ReqHTTP({method} {uri}) - Body({content})")
+    traced = self.konnect.tracer.allowRoute(uri)
 
-    try:
-      response, code = self.process(method, uri, content)
-      response["success"] = True
-    except Exception as e:
-      if isinstance(e, ApiError):
-        response = {"message": e.args[0]}
-        code = e.code
-
-        if e.parent:
-          response["exception"] = e.parent
-      else:
-        print_exc()
-        response = {"message": "unknown error", "exception": str(e)}
-        code = 500
-
-      response["success"] = False
+    if getLogger().isEnabledFor(DEBUG):
+      debug(f"ReqHTTP({method} {uri}) - Body({content})")
+    elif traced:
+      info(f"ReqHTTP({method} {uri}) - Body({content})")
 
-    request.setResponseCode(code)
-    address = request.getClientAddress()
+    etag = None
+
+    if method == "GET" and (version := self.versions.get(uri)):
+      etag = f'"{self.epoch}-{version()}"'.encode()
+
+      if request.setETag(etag) == CACHED:  # if-none-match matched, 304 without a body
+        self._logRequest(request, method, uri, 304, start)
+        return b""
+      elif (cached := self.bodies.get(uri)) and cached[0] == etag:
+        self._logRequest(request, method, uri, 200, start)
+        return cached[1]
 
-    debug(f"RespHTTP({code}) - Body({response})")
+    rendered = []
+    deferred = maybeDeferred(self.process, method, uri, content)
+    deferred.addCallbacks(self._handleSuccess, self._handleFailure)
+    deferred.addCallback(self._respond, request, method, uri, traced, start)
+
+    if etag:
+      deferred.addCallback(self._storeBody, request, uri, etag)
+
+    deferred.addCallback(rendered.append)
+
+    if rendered:
+      return rendered[0]
+
+    finished = []
+    request.notifyFinish().addBoth(finished.append)
+    deferred.addCallback(lambda _: self._write(request, rendered[0], finished))
+
+    return NOT_DONE_YET
+
+  def _handleSuccess(self, result):
+    response, code = result
+    response["success"] = True
+
+    return response, code
+
+  def _handleFailure(self, failure):
+    e = failure.value
+
+    if isinstance(e, ApiError):
+      response = {"message": e.args[0]}
+      code = e.code
+
+      if e.parent:
+        response["exception"] = e.parent
+    else:
+      failure.printTraceback()
+      response = {"message": "unknown error", "exception": str(e)}
+      code = 500
+
+    response["success"] = False
+
+    return response, code
+
+  def _recordRequest(self, uri, code, start):
+    route = uri.split("?", 1)[0].split("/")[1]
+    route = "/" + route if route in ROUTES else "other"
+    REQUESTS.inc(route, code)
+    LATENCY.observe(perf_counter() - start, route)
+
+  def _logRequest(self, request, method, uri, code, start):
+    address = request.getClientAddress()
+    self._recordRequest(uri, code, start)
 
     if isinstance(address, IPv4Address):
       info(f"{address.host}:{address.port} - {method} {uri} - {code}")
     else:
       info(f"unix:socket - {method} {uri} - {code}")
 
-    if debug:
+  def _respond(self, result, request, method, uri, traced, start):
+    response, code = result
+    request.setResponseCode(code)
+
+    if getLogger().isEnabledFor(DEBUG):
+      debug(f"RespHTTP({code}) - Body({response})")
+    elif traced:
+      info(f"RespHTTP({code}) - Body({response})")
+
+    self._logRequest(request, method, uri, code, start)
+
+    if self.debug:
       return dumps(response, indent=2).encode() + b"\n"
     else:
-      return dumps(response).encode()
+      return encode(response)
+
+  def _storeBody(self, body, request, uri, etag):
+    if request.code == 200:
+      self.bodies[uri] = (etag, body)
+
+    return body
+
+  def _write(self, request, body, finished):
+    if finished:  # client went away while the response was deferred
+      return
+
+    request.setHeader(b"content-length", b"%d" % len(body))
+    request.write(body)
+    request.finish()
 
   def process(self, method, uri, content):
-    if uri == "/" and method == "GET":
-      return self._handleInfo()
-    elif uri == "/" and method == "PUT":
-      return self._handleAnnounce()
-    elif uri == "/device" and method == "GET":
-      return self._handleDevices()
-    elif uri == "/command" and method == "GET":
-      return self._handleCommands()
-    elif uri == "/notification" and method == "GET":
-      return self._handleNotifications()
-    elif uri == "/version" and method == "GET":
-      return self._handleVersion()
-
-    matches = match(self.PATTERN, uri)
-
-    if not matches:
-      raise NotImplementedError2()
+    path, _, query = uri.partition("?")
 
-    try:
-      data = loads(content)
-    except JSONDecodeError as e:
-      raise UnserializationError(e)
+    if handler := self.routes.get((method, path)):
+      return handler(self._loadData(content, query))
 
-    resource = matches["res"]
-    checks = CHECKS.get((method, resource))
+    parts = path.split("/", 3)  # "", resource, device and key
+    route = self.resources.get((method, parts[1])) if len(parts) > 2 and parts[2] else None
 
-    if not checks:
+    if not route:
       raise NotImplementedError2()
 
-    identifier = self._getDeviceId(matches["dev"])
+    handler, trusted, reachable, keyed = route
+    data = self._loadData(content, query)
+    identifier = self._getDeviceId(parts[2], trusted or reachable)
 
-    if not self.database.isDeviceTrusted(identifier) and checks[0]:
+    if not self.database.isDeviceTrusted(identifier) and trusted:
       raise DeviceNotTrustedError()
 
     client = self.konnect.findClient(identifier)
 
-    if not client and checks[1]:
+    if not client and reachable:
       raise DeviceNotReachableError()
 
-    key = unquote_plus(matches["key"]) if matches["key"] else None
+    key = unquote_plus(parts[3]) if len(parts) > 3 and parts[3] else None
 
-    if key and not checks[2]:
+    if key and not keyed:
       raise NotImplementedError2()
 
-    if resource == "device" and method == "GET":
-      return self._handleGetDevice(identifier)
-    elif resource == "pair" and method == "POST":
-      return self._handlePair(client)
-    elif resource == "pair" and method == "DELETE":
-      return self._handleUnpair(identifier, client)
-    elif resource == "ping" and method == "POST":
-      return self._handlePing(client)
-    elif resource == "ring" and method == "POST":
-      return self._handleRing(client)
-    elif resource == "notification" and method == "POST":
-      return self._handleCreateNotification(identifier, client, data)
-    elif resource == "notification" and method == "DELETE":
-      return self._handleDeleteNotification(identifier, client, key)
-    elif resource == "command" and method == "GET":
-      return self._handleListCommands(identifier)
-    elif resource == "command" and method == "POST":
-      return self._handleCreateCommand(identifier, client, data)
-    elif resource == "command" and method == "PUT":
-      return self._handleUpdateCommand(identifier, client, key, data)
-    elif resource == "command" and method == "DELETE":
-      return self._handleDeleteCommand(identifier, client, key)
-    elif resource == "command" and method == "PATCH":
-      return self._handleExecuteCommand(client, key)
-    elif resource == "share" and method == "PATCH":
-      return self._handleUpdateShare(identifier, data)
-    elif resource == "custom" and method == "POST":
-      return self._handleCustomPacket(client, data)
-
-    raise NotImplementedError2()
-
-  def _handleInfo(self):
+    return handler(identifier, client, key, data)
+
+  def _loadData(self, content, query):
+    try:
+      data = loads(content or "{}")
+    except JSONDecodeError as e:
+      raise UnserializationError(e)
+
+    if query and isinstance(data, dict):  # the body wins over query string parameters
+      data = {**dict(parse_qsl(query)), **data}
+
+    return data
+
+  def _handleInfo(self, data):
     return {"identifier": self.konnect.identifier, "device": self.konnect.name,
-            "server": "Konnect " + __version__}, 200
+            "server": "Konnect " + __version__, "transfers": self.transfers.getStats(), "icons": self.icons.cache.getStats()}, 200
 
-  def _handleVersion(self):
+  def _handleVersion(self, data):
     return {"version": __version__}, 200
 
-  def _handleAnnounce(self):
+  def _handleDatabase(self, data):
+    return {"statements": self.database.getStatistics()}, 200
+
+  def _handleTraces(self, data):
+    return {"traces": self.konnect.tracer.getTraces()}, 200
+
+  def _getRoute(self, data):
+    route = data.get("route") if isinstance(data, dict) else None
+
+    if not isinstance(route, str) or not route.startswith("/"):
+      raise ApiError("route not found", 400)
+
+    return route
+
+  def _handleEnableRouteTrace(self, data):
+    return self._enableTrace(ROUTE, self._getRoute(data), data)
+
+  def _handleDisableRouteTrace(self, data):
+    return self._disableTrace(ROUTE, self._getRoute(data))
+
+  def _handleEnableDeviceTrace(self, identifier, client, key, data):  # devices may be traced before pairing
+    if not identifier:
+      raise ApiError("device not found", 404)
+
+    return self._enableTrace(DEVICE, identifier, data)
+
+  def _handleDisableDeviceTrace(self, identifier, client, key, data):
+    if not identifier:
+      raise ApiError("device not found", 404)
+
+    return self._disableTrace(DEVICE, identifier)
+
+  def _enableTrace(self, kind, key, data):
+    try:
+      sample = float(data.get("sample", TRACE_SAMPLE))
+      rate = float(data.get("rate", TRACE_RATE))
+      duration = float(data.get("duration", TRACE_DURATION))
+    except (TypeError, ValueError):
+      raise ApiError("sample, rate or duration invalid", 400)
+
+    if not 0 < sample <= 1 or rate <= 0 or duration <= 0:
+      raise ApiError("sample, rate or duration invalid", 400)
+
+    self.konnect.tracer.enable(kind, key, sample, rate, duration)
+
+    return {}, 200
+
+  def _disableTrace(self, kind, key):
+    if self.konnect.tracer.disable(kind, key):
+      return {}, 200
+
+    raise ApiError("trace not found", 404)
+
+  def _checkDebug(self):
+    if not self.debug:
+      raise ApiError("only available in debug mode", 403)
+
+  def _handleStartProfile(self, data):
+    self._checkDebug()
+
+    if not self.profiler.startCpu():
+      raise ApiError("profiler already running", 409)
+
+    return {}, 200
+
+  def _handleStopProfile(self, data):
+    self._checkDebug()
+
+    if (stats := self.profiler.stopCpu()) is None:
+      raise ApiError("profiler not running", 409)
+
+    return {"functions": stats}, 200
+
+  def _handleStartMemory(self, data):
+    self._checkDebug()
+
+    if not self.profiler.startMemory():
+      raise ApiError("memory tracing already running", 409)
+
+    return {}, 200
+
+  def _handleGetMemory(self, data):
+    self._checkDebug()
+
+    if (memory := self.profiler.getMemory()) is None:
+      raise ApiError("memory tracing not running", 409)
+
+    return memory, 200
+
+  def _handleStopMemory(self, data):
+    self._checkDebug()
+
+    if (memory := self.profiler.stopMemory()) is None:
+      raise ApiError("memory tracing not running", 409)
+
+    return memory, 200
+
+  def _handleAnnounce(self, data):
     try:
       self.discovery.announceIdentity()
       return {}, 200
     except Exception:
       raise ApiError("failed to broadcast identity packet", 500)
 
-  def _handleDevices(self):
-    return {"devices": list(self.konnect.getDevices().values())}, 200
+  def _handleDevices(self, data):
+    return {"devices": self.konnect.getDevices()}, 200
 
-  def _handleCommands(self):
-    return {"commands": self.database.listAllCommands()}, 200
+  def _handleCommands(self, data):
+    return self.database.listAllCommands().addCallback(lambda rows: ({"commands": rows}, 200))
 
-  def _handleNotifications(self):
-    return {"notifications": self.database.listAllNotifications()}, 200
+  def _handleNotifications(self, data):
+    return self.database.listAllNotifications().addCallback(lambda rows: ({"notifications": rows}, 200))
 
-  def _handlePair(self, client):
+  def _handlePair(self, identifier, client, key, data):
     client.sendPair()
     return {}, 200
 
-  def _handleUnpair(self, identifier, client):
-    self.database.unpairDevice(identifier)
-    client.sendUnpair()
-    return {}, 200
+  def _handleUnpair(self, identifier, client, key, data):
+    deferred = self.konnect.unpairDevice(identifier)
+
+    if client:
+      client.sendUnpair()
+
+    return deferred.addCallback(lambda _: ({}, 200))
+
+  def _handleGetDevice(self, identifier, client, key, data):
+    if device := self.konnect.getDevice(identifier):
+      if client:
+        device["queue"] = client.queue.getStats()
 
-  def _handleGetDevice(self, identifier):
-    for device in self.konnect.getDevices().values():
-      if device["identifier"] == identifier:
-        return device, 200
+      return device, 200
 
     raise Exception()
 
-  def _handlePing(self, client):
+  def _handlePing(self, identifier, client, key, data):
     client.sendPing()
     return {}, 200
 
-  def _handleRing(self, client):
+  def _handleRing(self, identifier, client, key, data):
     client.sendRing()
     return {}, 200
 
-  def _handleCreateNotification(self, identifier, client, data):
+  def _handleCreateNotification(self, identifier, client, key, data):
     if not data.get("text") or not data.get("title") or not data.get("application"):
       raise ApiError("text or title or application not found", 400)
 
@@ -249,113 +436,170 @@ class API(Resource):
     if not isinstance(reference, str) or len(reference) == 0:
       reference = str(uuid4())
 
-    payload = None
+    if client and icon and isfile(icon):
+      deferred = self.icons.process(icon)
+      deferred.addCallback(self._sendNotification, identifier, client, text, title, application, reference)
 
-    if icon and isfile(icon):
-      _, temp = mkstemp()
+      return deferred
 
-      with Image.open(icon) as image:
-        if image.format != "PNG" or max(image.size) > MAX_ICON_SIZE:
-          image.thumbnail([MAX_ICON_SIZE] * 2, Resampling.LANCZOS)
-          image.save(temp, "PNG")
-        else:
-          copyfile(icon, temp)
+    return self._sendNotification(None, identifier, client, text, title, application, reference)
 
-      with open(temp, "rb") as tmp:
-        digest = md5(tmp.read(), usedforsecurity=False).hexdigest()
+  def _sendNotification(self, icon, identifier, client, text, title, application, reference):
+    deferred = self.database.persistNotification(identifier, text, title, application, reference)
 
-      path = join(self.temp_dir, digest)
-      move(temp, path)
+    if client:
+      client.sendNotification(text, title, application, reference, self._addPayload(client, icon))
 
-      if port := self._startListener(path):
-        payload = {"digest": digest, "size": getsize(path), "port": port}
+    return deferred.addCallback(lambda _: ({"reference": reference}, 201))
 
-    self.database.persistNotification(identifier, text, title, application, reference)
+  def _addPayload(self, client, icon):
+    if not icon:
+      return None
 
-    if client:
-      client.sendNotification(text, title, application, reference, payload)
+    if port := self.transfers.addPayload(client.transport.getPeer().host, icon["path"], icon["digest"], icon["size"]):
+      return {"digest": icon["digest"], "size": icon["size"], "port": port}
+
+    return None
+
+  def _handleBatchNotifications(self, data):
+    if not isinstance(data, dict) or not isinstance(data.get("notifications"), list) or \
+      not (isinstance(data.get("devices"), list) or data.get("devices") == "*"):
+      raise ApiError("notifications or devices not found", 400)
+
+    notifications = []
+
+    for item in data["notifications"]:
+      if not isinstance(item, dict) or not item.get("text") or not item.get("title") or not item.get("application"):
+        raise ApiError("text or title or application not found", 400)
+
+      if item.get("icon") is not None and not isinstance(item["icon"], str):
+        raise ApiError("icon invalid", 400)
+
+      reference = item.get("reference", "")
+
+      if not isinstance(reference, str) or len(reference) == 0:
+        reference = str(uuid4())
+
+      notifications.append({"text": item["text"], "title": item["title"], "application": item["application"],
+                            "reference": reference, "icon": item.get("icon")})
+
+    targets = {}  # by identifier, a device named twice gets each notification once
+
+    if data["devices"] == "*":
+      for device in self.konnect.getDevices():
+        if device["trusted"]:
+          targets[device["identifier"]] = (device["identifier"], device["identifier"])
+    else:
+      for device in data["devices"]:
+        identifier = self._getDeviceId(device) if isinstance(device, str) and device else None
+        targets.setdefault(identifier or (None, repr(device)), (device, identifier))  # unresolved ones reported once
+
+    targets = list(targets.values())
+
+    connected = any(self.konnect.findClient(identifier) for _, identifier in targets)
+    icons = sorted({item["icon"] for item in notifications if item["icon"] and connected and isfile(item["icon"])})
+    deferred = gatherResults([self._processIcon(icon) for icon in icons])
+    deferred.addCallback(lambda processed: dict(zip(icons, processed)))
+    deferred.addCallback(self._sendBatchNotifications, notifications, targets)
 
-    return {"reference": reference}, 201
+    return deferred
 
-  def _startListener(self, path):
-    factory = Factory()
-    factory.protocol = ShareSend
-    factory.path = path
-    factory._stopListener = self._stopListener
+  def _processIcon(self, icon):  # a failed icon is sent without payload instead of failing the batch
+    deferred = maybeDeferred(self.icons.process, icon)
+    deferred.addErrback(lambda failure: warning(f"Icon {icon} failed: {failure.getErrorMessage()}"))
 
-    for port in range(MIN_XFER_PORT, MAX_XFER_PORT):
-      try:
-        listener = reactor.listenSSL(port, factory, self.konnect.options, backlog=0, interface="0.0.0.0")
-        debug(f"Transfer listening on port {port}")
-        factory.port = port
-        self.listeners[port] = listener
+    return deferred
 
-        return port
-      except CannotListenError:
-        pass
+  def _sendBatchNotifications(self, icons, notifications, targets):
+    rows = []
+    results = []
 
-    warning("Transfer couldn't find an available port")
-    raise ApiError("no available port", 400)
+    for device, identifier in targets:
+      if not self.database.isDeviceTrusted(identifier):
+        results.append({"device": device, "success": False, "message": DeviceNotTrustedError().args[0]})
+        continue
 
-  def _stopListener(self, port):
-    self.listeners[port].stopListening()
-    del self.listeners[port]
+      rows.extend((identifier, item["text"], item["title"], item["application"], item["reference"])
+                  for item in notifications)
+      results.append({"device": device, "identifier": identifier, "success": True, "reachable": False})
 
-  def _handleDeleteNotification(self, identifier, client, reference=None):
-    if not reference:
+    deferred = self.database.persistNotifications(rows)
+
+    for result in results:
+      if result["success"] and (client := self.konnect.findClient(result["identifier"])):
+        for item in notifications:
+          payload = self._addPayload(client, icons.get(item["icon"]))
+          client.sendNotification(item["text"], item["title"], item["application"], item["reference"], payload)
+
+        result["reachable"] = True
+
+    references = [item["reference"] for item in notifications]
+
+    return deferred.addCallback(lambda _: ({"references": references, "results": results}, 201))
+
+  def _handleDeleteNotification(self, identifier, client, key, data):
+    if not key:
       raise ApiError("reference not found", 400)
 
-    self.database.cancelNotification(identifier, reference)
+    deferred = self.database.cancelNotification(identifier, key)
 
     if client:
-      client.sendCancel(reference)
+      client.sendCancel(key)
 
-    return {}, 200
+    return deferred.addCallback(lambda _: ({}, 200))
 
-  def _handleListCommands(self, identifier):
-    return {"commands": self.database.listCommands(identifier)}, 200
+  def _handleListCommands(self, identifier, client, key, data):
+    return self.database.listCommands(identifier).addCallback(lambda rows: ({"commands": rows}, 200))
 
-  def _handleCreateCommand(self, identifier, client, data):
+  def _handleCreateCommand(self, identifier, client, key, data):
     if not data.get("name") or not data.get("command"):
       raise ApiError("name or command not found", 400)
 
     key = str(uuid4())
-    self.database.addCommand(identifier, key, data["name"], data["command"])
+    deferred = self.database.addCommand(identifier, key, data["name"], data["command"])
 
     if client:
       client.sendCommands()
 
-    return {"key": key}, 201
+    return deferred.addCallback(lambda _: ({"key": key}, 201))
 
   def _handleUpdateCommand(self, identifier, client, key, data):
     if not data.get("name") or not data.get("command"):
       raise ApiError("name or command not found", 400)
 
-    if self.database.getCommand(identifier, key):
-      self.database.updateCommand(identifier, key, data["name"], data["command"])
+    return self.database.getCommand(identifier, key).addCallback(self._updateCommand, identifier, client, key, data)
 
-      if client:
-        client.sendCommands()
+  def _updateCommand(self, command, identifier, client, key, data):
+    if not command:
+      raise ApiError("not found", 404)
 
-      return {}, 200
+    deferred = self.database.updateCommand(identifier, key, data["name"], data["command"])
 
-    raise ApiError("not found", 404)
+    if client:
+      client.sendCommands()
 
-  def _handleDeleteCommand(self, identifier, client, key=None):
+    return deferred.addCallback(lambda _: ({}, 200))
+
+  def _handleDeleteCommand(self, identifier, client, key, data):
     if key:
-      if self.database.getCommand(identifier, key):
-        self.database.remCommand(identifier, key)
-      else:
-        raise ApiError("not found", 404)
+      return self.database.getCommand(identifier, key).addCallback(self._deleteCommand, identifier, client, key)
+
+    return self._deleteCommand(None, identifier, client)
+
+  def _deleteCommand(self, command, identifier, client, key=None):
+    if key and not command:
+      raise ApiError("not found", 404)
+    elif key:
+      deferred = self.database.remCommand(identifier, key)
     else:
-      self.database.remCommands(identifier)
+      deferred = self.database.remCommands(identifier)
 
     if client:
       client.sendCommands()
 
-    return {}, 200
+    return deferred.addCallback(lambda _: ({}, 200))
 
-  def _handleExecuteCommand(self, client, key):
+  def _handleExecuteCommand(self, identifier, client, key, data):
     if key.startswith("="):
       for key2, item in client.commands.items():
         if item["name"] == key[1:]:
@@ -368,15 +612,13 @@ class API(Resource):
     client.sendRun(key)
     return {}, 200
 
-  def _handleUpdateShare(self, identifier, data):
+  def _handleUpdateShare(self, identifier, client, key, data):
     if data.get("path") and not isdir(expanduser(expandvars(data.get("path")))):
       raise ApiError("path not found", 400)
 
-    self.database.setPath(identifier, data["path"])
-
-    return {}, 201
+    return self.konnect.setPath(identifier, data["path"]).addCallback(lambda _: ({}, 201))
 
-  def _handleCustomPacket(self, client, data):
+  def _handleCustomPacket(self, identifier, client, key, data):
     if not self.debug:
       raise ApiError("server is not in debug mode", 403)
 
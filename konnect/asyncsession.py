@@ -0,0 +1,87 @@
+from asyncio import IncompleteReadError, Semaphore, open_connection, open_unix_connection, wait_for
+from json import dumps
+from os.path import expanduser, expandvars
+
+from konnect.session import POOL_SIZE, TIMEOUT, Routes, parse
+
+
+class AsyncSession(Routes):  # asyncio variant of Session, every route method returns a coroutine
+  def __init__(self, port="8080", size=POOL_SIZE, timeout=TIMEOUT):
+    self.port = port
+    self.size = size
+    self.timeout = timeout
+    self.idle = []
+    self.slots = Semaphore(size)  # callers beyond the pool size wait for a connection
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *_):
+    await self.close()
+
+  async def close(self):
+    idle, self.idle = self.idle, []
+
+    for _, writer in idle:
+      writer.close()
+      await writer.wait_closed()
+
+  async def _connect(self):
+    if str(self.port).isdigit():
+      return await open_connection("localhost", int(self.port))
+
+    return await open_unix_connection(expanduser(expandvars(self.port)))
+
+  async def _exchange(self, reader, writer, raw):
+    writer.write(raw)
+    await writer.drain()
+    _, status, _ = (await reader.readuntil(b"\r\n")).decode("latin-1").split(" ", 2)
+    headers = {}
+
+    while (line := await reader.readuntil(b"\r\n")) != b"\r\n":
+      name, _, value = line.decode("latin-1").partition(":")
+      headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+      content = b""
+
+      while size := int((await reader.readuntil(b"\r\n")).split(b";")[0], 16):
+        content += (await reader.readexactly(size + 2))[:-2]
+
+      await reader.readuntil(b"\r\n")
+    else:
+      content = await reader.readexactly(int(headers.get("content-length", 0)))
+
+    return int(status), headers, content
+
+  async def request(self, method, uri, data=None):
+    async with self.slots:
+      return await self._request(method, uri, data)
+
+  async def _request(self, method, uri, data):
+    body = dumps(data or {}).encode()
+    raw = (f"{method} {uri} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+           f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+
+    while True:
+      reused = bool(self.idle)
+      reader, writer = self.idle.pop() if reused else await self._connect()
+
+      try:
+        status, headers, content = await wait_for(self._exchange(reader, writer, raw), self.timeout)
+        break
+      except (IncompleteReadError, ConnectionResetError, BrokenPipeError):
+        writer.close()
+
+        if not reused:  # an idle connection may have been closed by the server, a new one shouldn't
+          raise
+      except BaseException:
+        writer.close()
+        raise
+
+    if headers.get("connection", "").lower() == "close":
+      writer.close()
+    else:
+      self.idle.append((reader, writer))
+
+    return parse(status, headers.get("content-type"), content)
@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from datetime import datetime, timezone
+from hashlib import md5
+from io import BytesIO
+from json import dumps, loads
+from logging import WARNING
+from os import environ, remove, urandom
+from os.path import join
+from platform import python_version
+from resource import RUSAGE_SELF, getrusage
+from sys import executable
+from tempfile import TemporaryDirectory
+from time import perf_counter, process_time
+from uuid import uuid4
+
+from twisted.internet import reactor, task, utils
+from twisted.internet.defer import DeferredSemaphore, gatherResults, inlineCallbacks
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.ssl import Certificate
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.server import Site
+
+from konnect import __version__
+from konnect.api import API
+from konnect.database import PRAGMAS, Database
+from konnect.factories import KonnectFactory, TransferFactory
+from konnect.logs import setupLogging
+from konnect.metrics import IDENTITIES
+from konnect.packet import Packet, PacketType, decode
+from konnect.peer import FakePeer, connectPeer, fetchPayload, loadOptions, summarize
+from konnect.protocols import MIN_TCP_PORT, Discovery
+
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+
+TIMEOUT = 60
+QUEUE_LIMIT = 64 * 1024 * 1024
+UDP_BATCH = 50
+
+
+def measure(function, count):  # calls per second
+  start = perf_counter()
+
+  for _ in range(count):
+    function()
+
+  return count / (perf_counter() - start)
+
+
+class Server:  # daemon components wired like konnectd, on loopback and ephemeral ports
+  def __init__(self, path):
+    identifier = uuid4().hex
+    options = loadOptions(identifier, path)
+
+    self.database = Database(join(path, "konnect.db"))
+    self.konnect = KonnectFactory(self.database, identifier, "benchmark", options, QUEUE_LIMIT)
+    self.service = reactor.listenTCP(0, self.konnect, interface="127.0.0.1")
+    self.discovery = Discovery(identifier, "benchmark", self.service.getHost().port)
+    self.udp = reactor.listenUDP(0, self.discovery, interface="127.0.0.1")
+    self.transfers = TransferFactory(options)
+    self.transfers.startListening()
+    self.api = API(self.konnect, self.discovery, self.transfers, self.database, True)
+    self.http = reactor.listenTCP(0, Site(self.api), interface="127.0.0.1")
+
+
+class Sender(DatagramProtocol):
+  pass
+
+
+class Benchmark:
+  def __init__(self, args, path):
+    self.args = args
+    self.path = path
+    self.server = Server(join(path, "server"))
+    self.port = self.server.service.getHost().port
+    self.peers = []
+    self.pool = HTTPConnectionPool(reactor)
+    self.pool.maxPersistentPerHost = args.concurrency
+    self.agent = Agent(reactor, pool=self.pool)
+
+  def createPeer(self, index):
+    identifier = uuid4().hex
+    options = loadOptions(identifier, join(self.path, f"peer{index}"))
+
+    return FakePeer(identifier, f"peer{index}", options)
+
+  @inlineCallbacks
+  def connectionSetup(self):
+    pending = [self.createPeer(index) for index in range(self.args.connections)]  # key generation isn't timed
+    samples = []
+
+    for peer in pending:
+      start = perf_counter()
+      yield connectPeer("127.0.0.1", self.port, peer).addTimeout(TIMEOUT, reactor)
+      self.server.konnect.findClient(peer.identifier).sendPair()
+      yield peer.paired.addTimeout(TIMEOUT, reactor)
+      pong = peer.expect(PacketType.PING)
+      peer.sendPing()
+      yield pong.addTimeout(TIMEOUT, reactor)
+      samples.append(perf_counter() - start)
+      self.peers.append(peer)
+
+    return summarize(samples)
+
+  @inlineCallbacks
+  def packets(self):
+    peer = self.peers[0]
+    client = self.server.konnect.findClient(peer.identifier)
+    count = self.args.packets
+    senders = {
+      PacketType.PING: lambda index: client.sendPing(),
+      PacketType.RING: lambda index: client.sendRing(),
+      PacketType.NOTIFICATION: lambda index: client.sendNotification("text", "title", "benchmark", f"packet-{index}"),
+      PacketType.RUNCOMMAND_REQUEST: lambda index: client.sendRun(f"key-{index}"),
+    }
+    results = {"out": {}, "in": {}}
+
+    for type_, send in senders.items():
+      received = peer.expect(type_, count)
+      start = perf_counter()
+
+      for index in range(count):
+        send(index)
+
+      yield received.addTimeout(TIMEOUT, reactor)
+      results["out"][type_] = count / (perf_counter() - start)
+
+    received = peer.expect(PacketType.PING, count)
+    start = perf_counter()
+
+    for _ in range(count):
+      peer.sendPing()
+
+    yield received.addTimeout(TIMEOUT, reactor)
+    results["in"][PacketType.PING] = count / (perf_counter() - start)
+
+    return results
+
+  @inlineCallbacks
+  def _receive(self, packets, count, hook=None):  # lines fed straight to the daemon connection, replies drained after
+    peer = self.peers[0]
+    client = self.server.konnect.findClient(peer.identifier)
+    lines = [bytes(packet) for packet, _ in packets] * (count // len(packets))
+    replies = {}
+
+    for _, reply in packets * (count // len(packets)):
+      replies[reply] = replies.get(reply, 0) + 1
+
+    received = gatherResults([peer.expect(type_, total) for type_, total in replies.items()])
+    start = perf_counter()
+    cpu = process_time()
+
+    for line in lines:
+      if hook:
+        hook(client)
+
+      client.lineReceived(line)
+
+    cpu = process_time() - cpu
+    elapsed = perf_counter() - start
+    yield received.addTimeout(TIMEOUT, reactor)
+
+    return {"per_second": len(lines) / elapsed, "cpu_per_packet": cpu / len(lines)}
+
+  @inlineCallbacks
+  def trust(self):  # incoming pings with the in-memory trusted set and with the query it replaced
+    database = self.server.database
+    query = "SELECT COUNT(1) AS count FROM trusted_devices WHERE identifier = ?"
+    packets = [(Packet.createPing(), PacketType.PING)]
+    results = {"memory": (yield self._receive(packets, self.args.inbound))}
+    database.isDeviceTrusted = lambda identifier: database._execute(query, (identifier,))[0]["count"] == 1
+
+    try:
+      results["sqlite"] = yield self._receive(packets, self.args.inbound)
+    finally:
+      del database.isDeviceTrusted
+
+    return results
+
+  @inlineCallbacks
+  def chatty(self):  # cpu per packet for a peer mixing pings and command list requests, certificate cached or parsed
+    commands = Packet(PacketType.RUNCOMMAND_REQUEST)
+    commands.set("requestCommandList", True)
+    packets = [(Packet.createPing("benchmark"), PacketType.PING), (Packet.createPing(), PacketType.PING),
+               (commands, PacketType.RUNCOMMAND)]
+
+    def parse(client):  # what every secure packet cost before the handshake cached it
+      client.verified = Certificate(client.transport.getPeerCertificate()).getSubject().commonName.decode()
+
+    return {"cached": (yield self._receive(packets, self.args.inbound)),
+            "parsed": (yield self._receive(packets, self.args.inbound, parse))}
+
+  def codec(self):  # packets built and encoded, or decoded, per second with json and orjson, templates reuse the body
+    count = self.args.codec
+    commands = {f"key-{index}": {"name": f"command {index}", "command": "true"} for index in range(10)}
+    packets = {
+      PacketType.IDENTITY: lambda: Packet.createIdentity(self.server.konnect.identifier, "benchmark", self.port),
+      PacketType.PAIR: lambda: Packet.createPair(True),
+      PacketType.PING: lambda: Packet.createPing(),
+      PacketType.RING: lambda: Packet.createRing(),
+      PacketType.NOTIFICATION: lambda: Packet.createNotification("text", "title", "benchmark", "reference"),
+      PacketType.RUNCOMMAND: lambda: Packet.createCommands(commands),
+    }
+    codecs = {"json": (lambda data: dumps(data, separators=(",", ":")).encode(), loads)}
+
+    if orjson:
+      codecs["orjson"] = (orjson.dumps, orjson.loads)
+
+    results = {}
+
+    for type_, create in packets.items():
+      line = bytes(create())
+      results[type_] = {"encode": {}, "decode": {}}
+
+      if create().tail:
+        results[type_]["encode"]["template"] = measure(lambda: bytes(create()), count)
+
+      for name, (encoder, decoder) in codecs.items():
+        results[type_]["encode"][name] = measure(lambda: encoder(create().data), count)
+        results[type_]["decode"][name] = measure(lambda: decoder(line), count)
+
+    return results
+
+  def _request(self, method, uri, body=None):  # fires with (status, body)
+    producer = None
+
+    if body is not None:
+      producer = FileBodyProducer(BytesIO(dumps(body).encode()))
+
+    port = self.server.http.getHost().port
+    deferred = self.agent.request(method.encode(), f"http://127.0.0.1:{port}{uri}".encode(),
+                                  Headers({"content-type": ["application/json"]}), producer)
+
+    return deferred.addCallback(lambda response: readBody(response).addCallback(lambda body: (response.code, body)))
+
+  @inlineCallbacks
+  def _cycle(self, steps):  # requests in order, any unexpected status aborts the benchmark
+    for method, uri, body, expected in steps:
+      code, content = yield self._request(method, uri, body)
+
+      if code != expected:
+        raise RuntimeError(f"{method} {uri} answered {code} instead of {expected}: {content[:200]}")
+
+  @inlineCallbacks
+  def api(self):  # every route except PUT / (broadcasts), the server runs in debug mode for the debug-only ones
+    peer = self.peers[0]
+    identifier = peer.identifier
+    last = self.peers[-1].identifier
+    client = self.server.konnect.findClient(identifier)
+    peer.send(PacketType.RUNCOMMAND, {"commandList": dumps({"remote": {"name": "benchmark", "command": "true"}})})
+    deadline = perf_counter() + TIMEOUT
+
+    while not client.commands and perf_counter() < deadline:
+      yield task.deferLater(reactor, 0.01, lambda: None)
+
+    _, created = yield self._request("POST", f"/command/{identifier}", {"name": "benchmark", "command": "true"})
+    key = decode(created)["key"]
+    notification = {"text": "text", "title": "title", "application": "benchmark"}
+    count = self.args.requests
+    routes = [  # steps restore whatever state they toggle, so they run one cycle at a time
+      [("GET", "/", None, 200)],
+      [("GET", "/version", None, 200)],
+      [("GET", "/database", None, 200)],
+      [("GET", "/metrics", None, 200)],
+      [("GET", "/device", None, 200)],
+      [("GET", f"/device/{identifier}", None, 200)],
+      [("GET", "/device?reachable=1", None, 200)],
+      [("POST", f"/ping/{identifier}", None, 200)],
+      [("POST", f"/ring/{identifier}", None, 200)],
+      [("POST", f"/notification/{identifier}", notification, 201)],
+      [("POST", "/notification", {"notifications": [notification], "devices": [identifier]}, 201)],
+      [("DELETE", f"/notification/{identifier}/benchmark", None, 200)],
+      [("GET", "/notification", None, 200)],
+      [("GET", "/command", None, 200)],
+      [("GET", f"/command/{identifier}", None, 200)],
+      [("POST", f"/command/{identifier}", {"name": "benchmark", "command": "true"}, 201)],
+      [("PUT", f"/command/{identifier}/{key}", {"name": "benchmark", "command": "false"}, 200)],
+      [("PATCH", f"/command/{identifier}/remote", None, 200)],
+      [("PATCH", f"/share/{identifier}", {"path": self.path}, 201)],
+      [("PUT", "/trace", {"route": "/version", "sample": 0.5}, 200), ("GET", "/trace", None, 200),
+       ("DELETE", "/trace?route=/version", None, 200)],
+      [("PUT", f"/trace/{identifier}", {"sample": 0.5}, 200), ("DELETE", f"/trace/{identifier}", None, 200)],
+      [("PUT", "/profile", None, 200), ("DELETE", "/profile", None, 200)],
+      [("PUT", "/memory", None, 200), ("GET", "/memory", None, 200), ("DELETE", "/memory", None, 200)],
+      [("POST", f"/custom/{identifier}", {"type": "kdeconnect.ping"}, 200)],
+      [("GET", "/unknown", None, 501)],
+      [("DELETE", f"/command/{identifier}", None, 200)],
+    ]
+    results = {}
+
+    for steps in routes:
+      concurrency = self.args.concurrency if len(steps) == 1 else 1
+      semaphore = DeferredSemaphore(concurrency)
+      start = perf_counter()
+      yield gatherResults([semaphore.run(self._cycle, steps) for _ in range(count)], consumeErrors=True)
+      name = " + ".join(f"{method} {uri}" for method, uri, _, _ in steps)
+      results[name.replace(identifier, "<id>").replace(key, "<key>")] = count / (perf_counter() - start)
+
+    if last != identifier:  # the peer pairs again on its own, once is enough
+      start = perf_counter()
+      yield self._cycle([("DELETE", f"/pair/{last}", None, 200), ("POST", f"/pair/{last}", None, 200)])
+      results["DELETE /pair/<last> + POST /pair/<last>"] = 1 / (perf_counter() - start)
+
+    return results
+
+  @inlineCallbacks
+  def replay(self):
+    peer = self.peers[0]
+    count = self.args.replay
+    yield self.server.database.persistNotifications([(peer.identifier, "text", "title", "benchmark", f"replay-{index}")
+                                                     for index in range(count)])
+    received = peer.expect(PacketType.NOTIFICATION, count)
+    start = perf_counter()
+    peer.requestNotifications()
+    yield received.addTimeout(TIMEOUT + count, reactor)
+
+    return {"notifications": count, "seconds": perf_counter() - start}
+
+  @inlineCallbacks
+  def database(self):  # notification insert and dismiss churn, tuned pragmas against sqlite defaults
+    count = self.args.churn
+    results = {}
+
+    for name, pragmas in [("tuned", PRAGMAS), ("defaults", [])]:
+      database = Database(join(self.path, f"churn-{name}.db"), pragmas)
+      yield database.pairDevice("churn", "certificate", "churn", "phone")
+      results[name] = {}
+
+      for mode in ["batched", "sequential"]:  # all writes queued at once (group commit) or one commit each
+        start = perf_counter()
+        writes = []
+
+        for index in range(count):
+          reference = f"{mode}-{index}"
+          pending = [database.persistNotification("churn", "text", "title", "benchmark", reference),
+                     database.dismissNotification("churn", reference)]
+
+          if mode == "sequential":
+            yield gatherResults(pending)
+          else:
+            writes.extend(pending)
+
+        yield gatherResults(writes)
+        results[name][mode] = count * 2 / (perf_counter() - start)
+
+    return results
+
+  @inlineCallbacks
+  def transfer(self):  # ascending sizes, peak rss is a high-water mark so each size shows what it added
+    path = join(self.path, "payload")
+    results = {"peak_rss": getrusage(RUSAGE_SELF).ru_maxrss * 1024, "payloads": []}
+
+    for mebibytes in sorted(self.args.transfer_sizes):
+      size = mebibytes * 1024 * 1024
+      samples = []
+
+      with open(path, "wb") as payload:  # written in chunks, a payload in memory would skew the rss
+        for _ in range(mebibytes):
+          payload.write(urandom(1024 * 1024))
+
+      for index in range(self.args.transfers):
+        digest = md5(b"%d-%d" % (mebibytes, index)).hexdigest()
+        port = self.server.transfers.addPayload("127.0.0.1", path, digest, size)
+        received, seconds = yield fetchPayload("127.0.0.1", port, self.peers[0].options, size).addTimeout(
+          TIMEOUT + mebibytes // 10, reactor)
+
+        if received != size:
+          raise RuntimeError(f"Transfer incomplete ({received}/{size} bytes)")
+
+        samples.append(size / seconds)
+
+      remove(path)
+      results["payloads"].append({"bytes": size, **summarize(samples),
+                                  "peak_rss": getrusage(RUSAGE_SELF).ru_maxrss * 1024})
+
+    return results
+
+  @inlineCallbacks
+  def discovery(self):
+    sender = Sender()
+    udp = reactor.listenUDP(0, sender, interface="127.0.0.1")
+    address = ("127.0.0.1", self.server.udp.getHost().port)
+    count = self.args.datagrams
+    accepted = IDENTITIES.values.get(("accepted",), 0)
+    start = perf_counter()
+
+    for index in range(count):
+      packet = Packet.createIdentity(uuid4().hex, f"udp{index}", MIN_TCP_PORT)
+      sender.transport.write(bytes(packet), address)
+
+      if index % UDP_BATCH == UDP_BATCH - 1 or index == count - 1:  # wait for the daemon to drain its socket
+        deadline = perf_counter() + 1
+
+        while IDENTITIES.values.get(("accepted",), 0) - accepted <= index and perf_counter() < deadline:
+          yield task.deferLater(reactor, 0, lambda: None)
+
+    elapsed = perf_counter() - start
+    processed = IDENTITIES.values.get(("accepted",), 0) - accepted
+    udp.stopListening()
+
+    return {"datagrams": count, "processed": processed, "per_second": processed / elapsed}
+
+  @inlineCallbacks
+  def startup(self):  # wall time of whole konnect invocations, interpreter start included
+    identifier = self.peers[0].identifier
+    port = str(self.server.http.getHost().port)
+    actions = {
+      "interpreter": ["-c", ""],
+      "help": ["-m", "konnect.client", "help"],
+      "version": ["-m", "konnect.client", "--port", port, "version"],
+      "devices": ["-m", "konnect.client", "--port", port, "devices"],
+      "ping": ["-m", "konnect.client", "--port", port, "ping", "--device", identifier],
+      "notification": ["-m", "konnect.client", "--port", port, "notification", "--device", identifier,
+                       "--title", "title", "--text", "text", "--application", "benchmark"],
+      "notifications": ["-m", "konnect.client", "--port", port, "notifications"],
+    }
+    results = {}
+
+    for action, arguments in actions.items():
+      samples = []
+
+      for _ in range(self.args.startup):
+        start = perf_counter()
+        code = yield utils.getProcessValue(executable, arguments, environ)
+        samples.append(perf_counter() - start)
+
+        if code != 0:
+          raise RuntimeError(f"konnect {action} exited with {code}")
+
+      results[action] = summarize(samples)
+
+    return results
+
+  @inlineCallbacks
+  def run(self):
+    results = {"version": __version__, "python": python_version(),
+               "timestamp": datetime.now(timezone.utc).isoformat(), "parameters": vars(self.args)}
+    results["connection_setup"] = yield self.connectionSetup()
+    results["packets"] = yield self.packets()
+    results["trust"] = yield self.trust()
+    results["chatty"] = yield self.chatty()
+    results["codec"] = self.codec()
+    results["api"] = yield self.api()
+    results["replay"] = yield self.replay()
+    results["database"] = yield self.database()
+    results["transfer"] = yield self.transfer()
+    results["discovery"] = yield self.discovery()
+    results["startup"] = yield self.startup()
+
+    for peer in self.peers:
+      peer.transport.loseConnection()
+
+    yield self.pool.closeCachedConnections()
+    self.server.transfers.stopListening()
+
+    return results
+
+
+def start(reactor_, args):
+  directory = TemporaryDirectory(prefix="konnect-benchmark-")
+  deferred = Benchmark(args, directory.name).run()
+
+  def save(results):
+    output = dumps(results, indent=2)
+
+    if args.output:
+      with open(args.output, "w") as handle:
+        handle.write(output + "\n")
+    else:
+      print(output)
+
+  deferred.addCallback(save)
+  deferred.addBoth(lambda result: directory.cleanup() or result)
+
+  return deferred
+
+
+def main():
+  parser = ArgumentParser(prog="konnect-benchmark", formatter_class=ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--connections", metavar="COUNT", default=10, type=int, help="Peers to connect and pair")
+  parser.add_argument("--packets", metavar="COUNT", default=1000, type=int, help="Packets per packet type")
+  parser.add_argument("--inbound", metavar="COUNT", default=5000, type=int, help="Packets fed to a connection")
+  parser.add_argument("--codec", metavar="COUNT", default=20000, type=int, help="Encodes and decodes per packet type")
+  parser.add_argument("--requests", metavar="COUNT", default=500, type=int, help="Requests per api route")
+  parser.add_argument("--concurrency", metavar="COUNT", default=8, type=int, help="Concurrent api requests")
+  parser.add_argument("--replay", metavar="COUNT", default=50, type=int, help="Notifications to replay")
+  parser.add_argument("--churn", metavar="COUNT", default=2000, type=int, help="Notifications inserted and dismissed")
+  parser.add_argument("--transfers", metavar="COUNT", default=3, type=int, help="Payload transfers per size")
+  parser.add_argument("--transfer-sizes", metavar="MIB", default=[1, 100, 1024], nargs="+", type=int,
+                      help="Payload sizes")
+  parser.add_argument("--datagrams", metavar="COUNT", default=1000, type=int, help="UDP identity packets")
+  parser.add_argument("--startup", metavar="COUNT", default=10, type=int, help="Client invocations per action")
+  parser.add_argument("--output", metavar="FILE", default=None, help="Save results to file instead of stdout")
+
+  args = parser.parse_args()
+  setupLogging(WARNING)
+  task.react(start, [args])
+
+
+if __name__ == "__main__":
+  main()
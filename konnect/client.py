@@ -1,14 +1,113 @@
 #!/usr/bin/env python3
 
 import sys
-from argparse import ArgumentParser
-from json import loads
+from argparse import ArgumentParser, Namespace
+from collections import deque
+from http.client import HTTPException, HTTPResponse
+from json import JSONDecodeError, dumps, loads
 from os.path import expanduser, expandvars, isdir, join
 from traceback import print_exc
 
-from PIL import Image, UnidentifiedImageError
-from requests import request
-from requests.exceptions import ConnectionError
+from konnect.session import connect, quote
+
+
+CONCURRENCY = 8
+BATCH = {  # operation -> (action, required fields)
+  "notification": ("notification", ["device", "title", "text", "application"]),
+  "cancel": ("notification", ["device", "reference"]),
+  "ping": ("ping", ["device"]),
+  "ring": ("ring", ["device"]),
+  "exec": ("exec", ["device", "key"]),
+  "command": ("command", ["device"]),
+}
+BATCH_DEFAULTS = {"device": None, "key": None, "delete": False, "name": None, "command": None, "reference": None,
+                  "title": None, "text": None, "application": None, "icon": None}
+
+
+class SharedReader:  # one buffered reader for every pipelined response, they can't close it
+  def __init__(self, fp):
+    self.fp = fp
+
+  def __getattr__(self, name):
+    return getattr(self.fp, name)
+
+  def close(self):
+    pass
+
+
+class Pipeline:  # http/1.1 pipelining over one keep-alive connection, responses arrive in request order
+  def __init__(self, port, concurrency=CONCURRENCY):
+    self.port = port
+    self.concurrency = max(concurrency, 1)
+    self.pending = deque()
+    self.connection = None
+    self.reader = None
+
+  def makefile(self, mode):  # acts as the socket of the responses
+    return self.reader
+
+  def _connect(self):
+    if self.connection:
+      self.connection.close()
+
+    self.connection = connect(self.port)
+    self.connection.connect()
+    self.reader = SharedReader(self.connection.sock.makefile("rb"))
+
+    for _, raw, _ in self.pending:  # server closed before answering them
+      if raw:
+        self.connection.sock.sendall(raw)
+
+  def _send(self, tag, method, url, data):
+    body = dumps(data).encode()
+    raw = (f"{method} {url} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+           f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+    self.pending.append((tag, raw, None))
+    self.connection.sock.sendall(raw)
+
+  def _receive(self):
+    tag, raw, error = self.pending.popleft()
+
+    if raw is None:
+      return tag, None, error
+
+    response = HTTPResponse(self)
+    response.begin()
+    text = response.read()
+
+    if response.will_close:
+      self._connect()
+
+    try:
+      data = loads(text)
+    except ValueError:  # empty or not json, e.g. an html error page from a proxy
+      data = None
+
+    if not isinstance(data, dict):
+      data = {"success": response.status < 400}
+
+      if not data["success"]:
+        data["message"] = response.reason.lower() or "invalid response"
+
+    return tag, response.status, data
+
+  def run(self, requests):  # (tag, method, url, data) or (tag, None, None, error) -> (tag, status, data)
+    self._connect()
+
+    try:
+      for tag, method, url, data in requests:
+        if len(self.pending) >= self.concurrency:
+          yield self._receive()
+
+        if method is None:
+          self.pending.append((tag, None, data))
+        else:
+          self._send(tag, method, url, data)
+
+      while self.pending:
+        yield self._receive()
+    finally:
+      self.connection.close()
 
 
 def print_out(data, level=0, parent=None):  # FIXME
@@ -36,9 +135,9 @@ def print_out(data, level=0, parent=None):  # FIXME
         print(f"{''.ljust(level - 2)}- {value}")
 
 
-def query(args):
+def prepare(args):  # method, url and body of an action, ValueError when invalid
   method = None
-  url = f"http://localhost:{args.port}"
+  url = "/"
   data = {}
 
   if args.action == "info":
@@ -50,74 +149,73 @@ def query(args):
     method = "GET"
     url = join(url, "device")
     if args.device:
-      url = join(url, args.device)
+      url = join(url, quote(args.device))
   elif args.action == "announce":
     method = "PUT"
   elif args.action == "commands":
     method = "GET"
     url = join(url, "command")
     if args.device:
-      url = join(url, args.device)
+      url = join(url, quote(args.device))
   elif args.action == "notifications":
     method = "GET"
     url = join(url, "notification")
     if args.device:
-      url = join(url, args.device)
+      url = join(url, quote(args.device))
   else:
     if args.action == "device":
       method = "GET"
-      url = join(url, "device", args.device)
+      url = join(url, "device", quote(args.device))
     elif args.action == "pair":
       method = "POST"
-      url = join(url, "pair", args.device)
+      url = join(url, "pair", quote(args.device))
     elif args.action == "unpair":
       method = "DELETE"
-      url = join(url, "unpair", args.device)
+      url = join(url, "unpair", quote(args.device))
     elif args.action == "ring":
       method = "POST"
-      url = join(url, "ring", args.device)
+      url = join(url, "ring", quote(args.device))
     elif args.action == "ping":
       method = "POST"
-      url = join(url, "ping", args.device)
+      url = join(url, "ping", quote(args.device))
     elif args.action == "custom":
       method = "POST"
-      url = join(url, "custom", args.device)
+      url = join(url, "custom", quote(args.device))
       try:
         data = loads(args.data)
       except Exception:
-        print("Error: invalid json")
-        sys.exit(1)
+        raise ValueError("invalid json")
     elif args.action == "command":
       if args.key:
         method = "DELETE" if args.delete else "PUT"
-        url = join(url, "command", args.device, args.key)
+        url = join(url, "command", quote(args.device), quote(args.key))
       else:
         method = "POST"
-        url = join(url, "command", args.device)
+        url = join(url, "command", quote(args.device))
       data["name"] = args.name
       data["command"] = args.command
     elif args.action == "notification":
       if args.cancel:
         method = "DELETE"
-        url = join(url, "notification", args.device, args.reference)
+        url = join(url, "notification", quote(args.device), quote(args.reference))
       else:
         method = "POST"
-        url = join(url, "notification", args.device)
+        url = join(url, "notification", quote(args.device))
         data["text"] = args.text
         data["title"] = args.title
         data["application"] = args.application
         data["reference"] = args.reference
 
         if args.icon:
+          from PIL import Image, UnidentifiedImageError  # only needed here, slow to import
+
           try:
             with Image.open(args.icon):
               data["icon"] = args.icon
           except (ValueError, UnidentifiedImageError):
-            print("Error: unsupported icon format")
-            sys.exit(1)
+            raise ValueError("unsupported icon format")
           except FileNotFoundError:
-            print("Error: icon not found")
-            sys.exit(1)
+            raise ValueError("icon not found")
     elif args.action == "receive":
       if args.stop:
         data["path"] = None
@@ -125,35 +223,47 @@ def query(args):
         data["path"] = expanduser(expandvars(args.path))
 
         if not isdir(data["path"]):
-          print("Error: directory not found")
-          sys.exit(1)
+          raise ValueError("directory not found")
 
       method = "PATCH"
-      url = join(url, "share", args.device)
+      url = join(url, "share", quote(args.device))
     elif args.action == "exec":
       method = "PATCH"
-      url = join(url, "command", args.device, args.key)
+      url = join(url, "command", quote(args.device), quote(args.key))
     else:
-      print("Error: action not implemented")
-      sys.exit(1)
+      raise ValueError("action not implemented")
+
+  return method, url, data
+
+
+def query(args):
+  try:
+    method, url, data = prepare(args)
+  except ValueError as e:
+    print(f"Error: {e}")
+    sys.exit(1)
 
   if args.debug:
     print("REQUEST:", method, url)
     print("", data)
 
   try:
-    response = request(method, url, json=data, timeout=60)
-  except ConnectionError:
+    connection = connect(args.port)
+    connection.request(method, url, dumps(data), {"Content-Type": "application/json"})
+    response = connection.getresponse()
+    text = response.read().decode()
+    connection.close()
+  except (OSError, HTTPException):
     print("ERROR: cannot connect to server")
     sys.exit(1)
 
   if args.debug:
-    print("RESPONSE:", response.status_code, response.headers.get("content-type"))
-    print("", response.text)
+    print("RESPONSE:", response.status, response.getheader("content-type"))
+    print("", text)
 
   try:
-    if len(response.text):
-      data = response.json()
+    if len(text):
+      data = loads(text)
   except Exception as e:
     print("EXCEPTION:")
     print_exc(e)
@@ -164,14 +274,65 @@ def query(args):
   sys.exit(int(not data["success"]))
 
 
+def operations(lines):  # json lines -> requests for the pipeline, invalid ones carry their error
+  for number, line in enumerate(lines, 1):
+    if not line.strip():
+      continue
+
+    id_ = None
+
+    try:
+      operation = loads(line)
+      id_ = operation.get("id")
+      name = operation.pop("operation", None)
+
+      if name not in BATCH:
+        raise ValueError(f"expected operation {', '.join(BATCH)}")
+
+      action, required = BATCH[name]
+
+      if missing := [field for field in required if not operation.get(field)]:
+        raise ValueError(f"missing {', '.join(missing)}")
+
+      if unknown := set(operation) - set(BATCH_DEFAULTS) - {"id"}:
+        raise ValueError(f"unknown {', '.join(sorted(unknown))}")
+
+      args = Namespace(**{**BATCH_DEFAULTS, **operation, "action": action, "cancel": name == "cancel"})
+      yield (number, id_), *prepare(args)
+    except JSONDecodeError:
+      yield (number, id_), None, None, {"success": False, "message": "invalid json"}
+    except ValueError as e:
+      yield (number, id_), None, None, {"success": False, "message": str(e)}
+    except (TypeError, AttributeError):
+      yield (number, id_), None, None, {"success": False, "message": "invalid operation"}
+
+
+def batch(args):
+  failed = False
+
+  try:
+    for (number, id_), status, data in Pipeline(args.port, args.concurrency).run(operations(sys.stdin)):
+      result = {"line": number, **({"id": id_} if id_ is not None else {}), "status": status, **data}
+      failed |= not data.get("success")
+      print(dumps(result), flush=True)
+  except (OSError, HTTPException):
+    print("ERROR: cannot connect to server")
+    sys.exit(1)
+
+  sys.exit(int(failed))
+
+
 def main():
   parser = ArgumentParser(prog="konnect", add_help=False, allow_abbrev=False)
-  parser.add_argument("--port", default=8080, type=int, help="Port running the admin interface")
+  parser.add_argument("--port", default="8080", type=str, help="Port or unix socket running the admin interface")
   parser.add_argument("--debug", action="store_true", help="Show debug messages")
 
   subparsers = parser.add_subparsers(dest="action", title="actions")
   subparsers.add_parser("announce", help="Announce your identity")
 
+  batch_ = subparsers.add_parser("batch", help="Send json lines operations from stdin...")
+  batch_.add_argument("--concurrency", metavar="COUNT", default=CONCURRENCY, type=int, help="Requests in flight")
+
   command = subparsers.add_parser("command", help="Configure local commands...")
   command.add_argument("--device", metavar="DEV", required=True, help="Device @name or id")
   command.add_argument("--delete", action="store_true", help="Delete command")
@@ -240,6 +401,9 @@ def main():
     parser.print_help()
     sys.exit(0)
 
+  if args.action == "batch":
+    batch(args)
+
   query(args)
 
 
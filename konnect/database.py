@@ -1,5 +1,27 @@
-from logging import debug
+from bisect import bisect_left
+from collections import deque
+from logging import DEBUG, debug, error, getLogger
+from queue import Queue
 from sqlite3 import OperationalError, connect
+from threading import Lock, Thread
+from time import perf_counter
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from konnect.metrics import LATENCY_BUCKETS, formatHistogram
+
+
+MAX_BATCH_SIZE = 256
+PRAGMAS = [
+  "PRAGMA synchronous=NORMAL",  # consistent with WAL, but a power loss may undo the last commits (fsync on checkpoints)
+  "PRAGMA cache_size=-8192",
+  "PRAGMA mmap_size=67108864",
+  "PRAGMA temp_store=MEMORY",
+]
 
 
 class Database:
@@ -24,32 +46,197 @@ class Database:
     ],
   ]
 
-  def __init__(self, path):
-    self.instance = connect(path, isolation_level=None, check_same_thread=False)
-    self.instance.row_factory = self._dict_factory
+  def __init__(self, path, pragmas=PRAGMAS):
+    self.path = path
+    self.pragmas = pragmas
+    self.statements = {}
+    self.lock = Lock()
+    self.instance = self._connect()
+    self.instance.execute("PRAGMA journal_mode=WAL")
     self._upgradeSchema()
+    self.trusted = {row["identifier"] for row in self._execute("SELECT identifier FROM trusted_devices")}
 
-  def _dict_factory(self, cursor, row):
-    fields = [column[0] for column in cursor.description]
-    return dict(zip(fields, row))
+    self.queue = Queue()
+    self.queued = 0  # sequence of the last queued write
+    self.committed = 0  # sequence of the last write whose result was delivered
+    self.barriers = deque()  # reads waiting for a write sequence to be committed
+    self.writer = Thread(target=self._writerLoop, name="database-writer", daemon=True)
+    self.readers = ThreadPool(1, 1, "database-reader")
+    self.reader = None
 
-  def _execute(self, query, params=()):
-    debug(f"Query({query}) - Params({params})")
-    result = self.instance.execute(query, params)
-    keyword = query.split(" ", 1)[0].upper()
+    reactor.callWhenRunning(self._start)
+    reactor.addSystemEventTrigger("during", "shutdown", self._stop)
 
-    if keyword == "SELECT":
-      result = result.fetchall()
-      debug(f"Result({result})")
-    elif keyword == "INSERT":
+  def _connect(self):
+    instance = connect(self.path, isolation_level=None, check_same_thread=False)
+
+    for pragma in self.pragmas:
+      instance.execute(pragma)
+
+    return instance
+
+  def _start(self):
+    self.reader = self._connect()
+    self.writer.start()
+    self.readers.start()
+
+  def _stop(self):
+    if self.writer.is_alive():  # the reactor may stop before it started
+      self.queue.put(None)
+      self.writer.join()
+
+    self.readers.stop()
+
+  def _getStatement(self, query):
+    if statement := self.statements.get(query):
+      return statement
+
+    with self.lock:
+      return self.statements.setdefault(query, {"keyword": query.split(" ", 1)[0].upper(), "count": 0,
+                                                "time": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)})
+
+  def _recordStatement(self, statement, elapsed):
+    with self.lock:
+      statement["count"] += 1
+      statement["time"] += elapsed
+      statement["buckets"][bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+  def _execute(self, query, params=(), instance=None):
+    verbose = getLogger().isEnabledFor(DEBUG)
+
+    if verbose:
+      debug(f"Query({query}) - Params({params})")
+
+    statement = self._getStatement(query)
+    start = perf_counter()
+    result = (instance or self.instance).execute(query, params)
+
+    if statement["keyword"] == "SELECT":
+      fields = [column[0] for column in result.description]
+      result = [dict(zip(fields, row)) for row in result.fetchall()]
+    elif statement["keyword"] == "INSERT":
       result = result.lastrowid
-      debug(f"LastRowId({result})")
-    elif keyword in ["UPDATE", "DELETE"]:
+    elif statement["keyword"] in ["UPDATE", "DELETE"]:
       result = result.rowcount
-      debug(f"RowCount({result})")
+
+    self._recordStatement(statement, perf_counter() - start)
+
+    if verbose:
+      debug(f"Result({result})")
 
     return result
 
+  def _executemany(self, query, params, instance=None):
+    if getLogger().isEnabledFor(DEBUG):
+      debug(f"Query({query}) - Params({params})")
+
+    statement = self._getStatement(query)
+    start = perf_counter()
+    result = (instance or self.instance).executemany(query, params).rowcount
+    self._recordStatement(statement, perf_counter() - start)
+
+    return result
+
+  def getStatistics(self):
+    with self.lock:
+      return [{"query": query, "count": item["count"], "time": item["time"],
+               "buckets": dict(zip([*map(str, LATENCY_BUCKETS), "+Inf"], item["buckets"]))}
+              for query, item in self.statements.items()]
+
+  def collectMetrics(self):
+    name = "konnect_database_query_seconds"
+    lines = [f"# HELP {name} Database statement latency", f"# TYPE {name} histogram"]
+
+    with self.lock:
+      for query, item in self.statements.items():
+        lines.extend(formatHistogram(name, ["query"], [query], LATENCY_BUCKETS, item["buckets"], item["time"],
+                                     item["count"]))
+
+    return lines
+
+  def _read(self, query, params=()):
+    deferred = Deferred()
+
+    if self.committed < self.queued:  # wait until every write queued before this read is committed
+      self.barriers.append((self.queued, deferred))
+    else:
+      deferred.callback(None)
+
+    deferred.addCallback(lambda _: deferToThreadPool(reactor, self.readers, self._execute, query, params,
+                                                     self.reader))
+
+    return deferred
+
+  def _write(self, query, params=(), many=False):
+    deferred = Deferred()
+    self.queued += 1
+    self.queue.put((self.queued, query, params, many, deferred))
+
+    return deferred
+
+  def _writerLoop(self):  # runs in its own thread, every queued write is group committed
+    instance = self._connect()
+    running = True
+
+    while running:
+      batch = [self.queue.get()]
+
+      while batch[-1] is not None and len(batch) < MAX_BATCH_SIZE and not self.queue.empty():
+        batch.append(self.queue.get())
+
+      if batch[-1] is None:
+        running = False
+        batch.pop()
+
+      if not batch:
+        continue
+
+      try:
+        results = self._commitBatch(instance, batch)
+      except Exception as e:  # every write of the batch fails, the next batch starts clean
+        error(f"Batch failed: {e}")
+        results = [Failure()] * len(batch)
+
+        if instance.in_transaction:
+          try:
+            instance.execute("ROLLBACK")
+          except Exception:
+            pass
+
+      for (sequence, _, _, _, deferred), result in zip(batch, results):
+        reactor.callFromThread(self._written, sequence, deferred, result)
+
+    instance.close()
+
+  def _commitBatch(self, instance, batch):
+    results = []
+    instance.execute("BEGIN")
+
+    for _, query, params, many, _ in batch:
+      try:
+        if many:
+          results.append(self._executemany(query, params, instance))
+        else:
+          results.append(self._execute(query, params, instance))
+      except Exception as e:
+        error(f"Query failed: {e}")
+        results.append(Failure())
+
+    instance.execute("COMMIT")
+
+    return results
+
+  def _written(self, sequence, deferred, result):
+    self.committed = sequence
+
+    while self.barriers and self.barriers[0][0] <= sequence:
+      self.barriers.popleft()[1].callback(None)
+
+    if isinstance(result, Failure):
+      deferred.errback(result)
+    else:
+      deferred.callback(result)
+
   def _upgradeSchema(self):
     version = int(self.loadConfig("schema", -1))
 
@@ -74,11 +261,7 @@ class Database:
     self._execute(query, (key, value))
 
   def isDeviceTrusted(self, identifier):
-    query = "SELECT COUNT(1) AS count FROM trusted_devices WHERE identifier = ?"
-    try:
-      return int(self._execute(query, (identifier,))[0]["count"]) == 1
-    except IndexError:
-      return False
+    return identifier in self.trusted
 
   def getTrustedDevices(self):
     query = "SELECT identifier, name, type, path FROM trusted_devices"
@@ -92,78 +275,88 @@ class Database:
 
   def updateDevice(self, identifier, name, device):
     query = "UPDATE trusted_devices SET name = ?, type = ? WHERE identifier = ?"
-    self._execute(query, (name, device, identifier))
+    return self._write(query, (name, device, identifier))
 
   def pairDevice(self, identifier, certificate, name, device):
     query = "INSERT INTO trusted_devices (identifier, certificate, name, type) VALUES (?, ?, ?, ?)"
-    self._execute(query, (identifier, certificate, name, device))
+    self.trusted.add(identifier)
+    return self._write(query, (identifier, certificate, name, device)).addErrback(self._reloadTrusted, identifier)
 
   def unpairDevice(self, identifier):
     query = "DELETE FROM trusted_devices WHERE identifier = ?"
-    self._execute(query, (identifier,))
+    self.trusted.discard(identifier)
+    return self._write(query, (identifier,)).addErrback(self._reloadTrusted, identifier)
+
+  def _reloadTrusted(self, failure, identifier):  # trusted is changed before the write commits, undone if it fails
+    if self._execute("SELECT identifier FROM trusted_devices WHERE identifier = ?", (identifier,)):
+      self.trusted.add(identifier)
+    else:
+      self.trusted.discard(identifier)
+
+    return failure
 
   def persistNotification(self, identifier, text, title, application, reference):
     query = "INSERT INTO notifications (identifier, [text], title, application, reference) " \
       "VALUES (?, ?, ?, ?, ?) ON CONFLICT(identifier, reference) DO UPDATE SET text = excluded.text, " \
       "title = excluded.title, application = excluded.application"
-    self._execute(query, (identifier, text, title, application, reference))
+    return self._write(query, (identifier, text, title, application, reference))
+
+  def persistNotifications(self, notifications):
+    query = "INSERT INTO notifications (identifier, [text], title, application, reference) " \
+      "VALUES (?, ?, ?, ?, ?) ON CONFLICT(identifier, reference) DO UPDATE SET text = excluded.text, " \
+      "title = excluded.title, application = excluded.application"
+    return self._write(query, notifications, True)
 
   def dismissNotification(self, identifier, reference):
     query = "DELETE FROM notifications WHERE identifier = ? AND reference = ?"
-    self._execute(query, (identifier, reference))
+    return self._write(query, (identifier, reference))
 
   def cancelNotification(self, identifier, reference):
     query = "UPDATE notifications SET cancel = ? WHERE identifier = ? AND reference = ?"
-    self._execute(query, (1, identifier, reference))
+    return self._write(query, (1, identifier, reference))
 
   def listNotifications(self, identifier):
     query = "SELECT cancel, reference, [text], title, application FROM notifications WHERE identifier = ?"
-    return self._execute(query, (identifier,))
+    return self._read(query, (identifier,))
 
   def listAllNotifications(self):
     query = "SELECT d.identifier, d.name AS device, n.reference, n.[text], n.title, n.application, n.cancel " \
       "FROM notifications n INNER JOIN trusted_devices d ON (n.identifier = d.identifier) ORDER BY 2, 4"
-    return self._execute(query)
+    return self._read(query)
 
   def addCommand(self, identifier, key, name, command):
     query = "INSERT INTO commands (key, identifier, name, command) VALUES (?, ?, ?, ?)"
-    self._execute(query, (key, identifier, name, command))
+    return self._write(query, (key, identifier, name, command))
 
   def updateCommand(self, identifier, key, name, command):
     query = "UPDATE commands SET name = ?, command = ? WHERE identifier = ? AND key = ?"
-    self._execute(query, (name, command, identifier, key))
+    return self._write(query, (name, command, identifier, key))
 
   def remCommands(self, identifier):
     query = "DELETE FROM commands WHERE identifier = ?"
-    self._execute(query, (identifier,))
+    return self._write(query, (identifier,))
 
   def remCommand(self, identifier, key):
     query = "DELETE FROM commands WHERE identifier = ? AND key = ?"
-    self._execute(query, (identifier, key))
+    return self._write(query, (identifier, key))
 
   def getCommand(self, identifier, key):
     query = "SELECT command FROM commands WHERE identifier = ? AND key = ?"
-    try:
-      return self._execute(query, (identifier, key))[0]["command"]
-    except IndexError:
-      return None
+    return self._read(query, (identifier, key)).addCallback(lambda rows: rows[0]["command"] if rows else None)
 
   def listCommands(self, identifier):
     query = "SELECT key, name, command FROM commands WHERE identifier = ?"
-    return self._execute(query, (identifier,))
+    return self._read(query, (identifier,))
 
   def listAllCommands(self):
     query = "SELECT d.identifier, d.name AS device, c.key, c.name, c.command FROM commands c " \
       "INNER JOIN trusted_devices d ON (c.identifier = d.identifier) ORDER BY 2, 4"
-    return self._execute(query)
+    return self._read(query)
 
   def getPath(self, identifier):
     query = "SELECT path FROM trusted_devices WHERE identifier = ?"
-    try:
-      return self._execute(query, (identifier, ))[0]["path"]
-    except IndexError:
-      return None
+    return self._read(query, (identifier,)).addCallback(lambda rows: rows[0]["path"] if rows else None)
 
   def setPath(self, identifier, path=None):
     query = "UPDATE trusted_devices SET path = ? WHERE identifier = ?"
-    self._execute(query, (path, identifier))
+    return self._write(query, (path, identifier))
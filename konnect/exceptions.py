@@ -33,3 +33,8 @@ class AlreadyPairedError(ApiError):
 class NotImplementedError2(ApiError):
   def __init__(self, parent=None):
     super().__init__("not implemented", 501, parent)
+
+
+class ServiceUnavailableError(ApiError):
+  def __init__(self, parent=None):
+    super().__init__("service unavailable", 503, parent)
@@ -1,35 +1,243 @@
+from logging import debug, warning
+
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
 from twisted.internet.protocol import Factory
 
-from konnect.protocols import Konnect
+from konnect.logs import Tracer
+from konnect.protocols import MAX_QUEUE_BYTES, MAX_TCP_PORT, MERGE, MIN_TCP_PORT, Konnect, ShareSend
+
+
+MIN_XFER_PORT = MIN_TCP_PORT + 1
+MAX_XFER_PORT = MAX_TCP_PORT - 1
+XFER_PORTS = 8  # kdeconnectd takes its payload ports from 1739 up, the pool stays below unless those are busy
+PAYLOAD_TIMEOUT = 60
+
+
+def normalizeName(name):
+  return name.strip().casefold()
 
 
 class KonnectFactory(Factory):
   protocol = Konnect
-  clients = set()
 
-  def __init__(self, database, identifier, name, options):
+  def __init__(self, database, identifier, name, options, queue_limit=MAX_QUEUE_BYTES, queue_policy=MERGE):
     self.database = database
     self.identifier = identifier
     self.name = name
     self.options = options
+    self.queue_limit = queue_limit
+    self.queue_policy = queue_policy
+    self.clients = set()
+    self.identifiers = {}
+    self.names = {}
+    self.delivered = {}  # identifier: {reference: (text, title, application)} sent during this run
+    self.devices = database.getTrustedDevices()  # device entries are replaced, never mutated
+    self.version = 0  # bumped on every change to devices
+    self.tracer = Tracer()
+
+  def registerClient(self, client):
+    self.identifiers[client.identifier] = client
+    self.names[normalizeName(client.name)] = client
+
+    if self.isDeviceTrusted(client.identifier):
+      self._updateDevice(client.identifier, reachable=True, commands=client.commands)
+    else:
+      self.devices[client.identifier] = self._clientDevice(client)
+      self.version += 1
+
+  def unregisterClient(self, client):
+    if self.names.get(normalizeName(client.name)) is client:
+      del self.names[normalizeName(client.name)]
+
+    if self.identifiers.get(client.identifier) is not client:
+      return
+
+    del self.identifiers[client.identifier]
+
+    if self.isDeviceTrusted(client.identifier):
+      self._updateDevice(client.identifier, reachable=False, commands={})
+    else:
+      del self.devices[client.identifier]
+      self.version += 1
 
   def findClient(self, identifier):
-    for client in self.clients:
-      if client.identifier == identifier:
-        return client
+    return self.identifiers.get(identifier)
 
-    return None
+  def findClientByName(self, name):
+    return self.names.get(normalizeName(name))
+
+  def isDeviceTrusted(self, identifier):  # the database set is the only source, device entries just mirror it
+    return self.database.isDeviceTrusted(identifier)
+
+  def _clientDevice(self, client):
+    return {"identifier": client.identifier, "name": client.name, "type": client.device, "reachable": True,
+            "trusted": False, "commands": client.commands, "path": None}
+
+  def _updateDevice(self, identifier, **changes):
+    self.devices[identifier] = {**self.devices[identifier], **changes}
+    self.version += 1
+
+  def pairDevice(self, client, certificate):
+    self._updateDevice(client.identifier, name=client.name, type=client.device, trusted=True, path=None)
+    deferred = self.database.pairDevice(client.identifier, certificate, client.name, client.device)
+
+    return deferred.addErrback(self._reloadDevice, client.identifier)
+
+  def updateDevice(self, client):
+    if self.isDeviceTrusted(client.identifier):
+      self._updateDevice(client.identifier, name=client.name, type=client.device)
+
+    return self.database.updateDevice(client.identifier, client.name, client.device)
+
+  def unpairDevice(self, identifier):
+    self.delivered.pop(identifier, None)
+
+    if client := self.findClient(identifier):
+      self.devices[identifier] = self._clientDevice(client)
+    else:
+      self.devices.pop(identifier, None)
+
+    self.version += 1
+
+    return self.database.unpairDevice(identifier).addErrback(self._reloadDevice, identifier)
+
+  def _reloadDevice(self, failure, identifier):  # a failed pair or unpair leaves the entry as the database has it
+    device = self.database.getTrustedDevices().get(identifier)
+
+    if client := self.findClient(identifier):
+      device = {**device, "reachable": True, "commands": client.commands} if device else self._clientDevice(client)
+
+    if device:
+      self.devices[identifier] = device
+    else:
+      self.devices.pop(identifier, None)
+
+    self.version += 1
+
+    return failure
+
+  def updateCommands(self, client):
+    if self.findClient(client.identifier) is client:
+      self._updateDevice(client.identifier, commands=client.commands)
+
+  def getPath(self, identifier):
+    return self.devices[identifier]["path"] if self.isDeviceTrusted(identifier) else None
+
+  def setPath(self, identifier, path=None):
+    if self.isDeviceTrusted(identifier):
+      self._updateDevice(identifier, path=path)
+
+    return self.database.setPath(identifier, path)
+
+  def getDevice(self, identifier):
+    device = self.devices.get(identifier)
+    return dict(device) if device else None
 
   def getDevices(self):
-    devices = self.database.getTrustedDevices()
-
-    for client in self.clients:
-      if client.identifier in devices:
-        devices[client.identifier]["commands"] = client.commands
-        devices[client.identifier]["reachable"] = True
-      else:
-        devices[client.identifier] = {"identifier": client.identifier, "name": client.name,
-                                      "type": client.device, "reachable": True, "trusted": False,
-                                      "commands": client.commands, "path": None}
-
-    return devices
+    return list(self.devices.values())
+
+  def checkConsistency(self):
+    errors = []
+    trusted = self.database.getTrustedDevices()
+
+    for identifier, device in trusted.items():
+      for key in ["name", "type", "trusted", "path"]:
+        if self.devices.get(identifier, {}).get(key) != device[key]:
+          errors.append(f"{identifier}: {key} differs from database")
+
+    if self.database.trusted != set(trusted):
+      errors.append("trusted set differs from database")
+
+    for identifier, device in self.devices.items():
+      if device["trusted"] and identifier not in trusted:
+        errors.append(f"{identifier}: trusted but not in database")
+      elif device["reachable"] and identifier not in self.identifiers:
+        errors.append(f"{identifier}: reachable but not connected")
+      elif not device["reachable"] and identifier in self.identifiers:
+        errors.append(f"{identifier}: connected but not reachable")
+      elif not device["trusted"] and not device["reachable"]:
+        errors.append(f"{identifier}: neither trusted nor reachable")
+
+    return errors
+
+
+class TransferFactory(Factory):
+  protocol = ShareSend
+
+  def __init__(self, options, port=MIN_XFER_PORT, count=XFER_PORTS):
+    self.options = options
+    self.port = port
+    self.count = count
+    self.listeners = {}
+    self.payloads = {}
+    self.digests = {}
+    self.served = 0
+    self.expired = 0
+
+  def startListening(self):
+    for port in range(self.port, self.port + MAX_XFER_PORT - MIN_XFER_PORT):
+      if len(self.listeners) == self.count:
+        break
+
+      try:
+        self.listeners[port] = reactor.listenSSL(port, self, self.options, interface="0.0.0.0")
+      except CannotListenError:
+        pass
+
+    if self.listeners:
+      debug(f"Transfers listening on {len(self.listeners)} ports")
+    else:
+      warning("Transfer couldn't find an available port")
+
+  def stopListening(self):
+    for listener in self.listeners.values():
+      listener.stopListening()
+
+    self.listeners.clear()
+
+  def addPayload(self, host, path, digest, size):
+    if port := self.digests.get((host, digest)):
+      payload = self.payloads[(port, host)]
+      payload["claims"] += 1
+      payload["expiry"].reset(PAYLOAD_TIMEOUT)
+      return port
+
+    for port in self.listeners:
+      if (port, host) not in self.payloads:
+        expiry = reactor.callLater(PAYLOAD_TIMEOUT, self._expirePayload, port, host)
+        self.payloads[(port, host)] = {"path": path, "digest": digest, "size": size, "claims": 1, "expiry": expiry}
+        self.digests[(host, digest)] = port
+        return port
+
+    warning(f"Transfer couldn't find an available port for {host}")
+    return None
+
+  def claimPayload(self, port, host):
+    payload = self.payloads.get((port, host))
+
+    if not payload:
+      return None
+
+    payload["claims"] -= 1
+    self.served += 1
+
+    if payload["claims"] == 0:
+      payload["expiry"].cancel()
+      self._removePayload(port, host)
+
+    return payload
+
+  def _expirePayload(self, port, host):
+    payload = self._removePayload(port, host)
+    self.expired += payload["claims"]
+    debug(f"Transfer of {payload['digest']} to {host} expired")
+
+  def _removePayload(self, port, host):
+    payload = self.payloads.pop((port, host))
+    del self.digests[(host, payload["digest"])]
+    return payload
+
+  def getStats(self):
+    return {"ports": len(self.listeners), "pending": sum(item["claims"] for item in self.payloads.values()),
+            "served": self.served, "expired": self.expired}
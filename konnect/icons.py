@@ -0,0 +1,171 @@
+from collections import OrderedDict
+from hashlib import md5
+from os import close, remove, scandir, stat
+from os.path import getsize, isfile, join
+from shutil import copyfile, move
+from tempfile import mkstemp
+
+from PIL import Image
+from PIL.Image import Resampling
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from konnect.exceptions import ServiceUnavailableError
+
+
+MAX_ICON_SIZE = 96
+ICON_WORKERS = 2
+MAX_ICON_QUEUE = 32
+MAX_CACHE_ENTRIES = 1024
+MAX_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class IconCache:
+  def __init__(self, temp_dir, max_entries=MAX_CACHE_ENTRIES, max_size=MAX_CACHE_SIZE):
+    self.temp_dir = temp_dir
+    self.max_entries = max_entries
+    self.max_size = max_size
+    self.index = OrderedDict()  # (path, mtime, size): processed icon, least recently used first
+    self.files = {}  # digest: {size, refs}, unreferenced files are kept in release order
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+    for entry in sorted(scandir(self.temp_dir), key=lambda item: item.stat().st_mtime):
+      if entry.is_file():
+        self.files[entry.name] = {"size": entry.stat().st_size, "refs": 0}
+        self.size += entry.stat().st_size
+
+    self._evict()
+
+  @staticmethod
+  def key(icon):
+    info = stat(icon)
+    return icon, info.st_mtime_ns, info.st_size
+
+  def get(self, key):
+    item = self.index.get(key)
+
+    if item and isfile(item["path"]):
+      self.index.move_to_end(key)
+      self.hits += 1
+      return item
+    elif item:
+      self._release(self.index.pop(key))
+
+    self.misses += 1
+    return None
+
+  def put(self, key, item):
+    if key in self.index:
+      self._release(self.index.pop(key))
+
+    if item["digest"] not in self.files:
+      self.files[item["digest"]] = {"size": item["size"], "refs": 0}
+      self.size += item["size"]
+
+    self.files[item["digest"]]["refs"] += 1
+    self.index[key] = item
+    self._evict()
+
+  def _release(self, item):
+    file = self.files[item["digest"]]
+    file["refs"] -= 1
+
+    if not file["refs"]:
+      self.files[item["digest"]] = self.files.pop(item["digest"])
+
+  def _remove(self, digest):
+    self.size -= self.files.pop(digest)["size"]
+    self.evictions += 1
+
+    try:
+      remove(join(self.temp_dir, digest))
+    except FileNotFoundError:
+      pass
+
+  def _evict(self):
+    while len(self.index) > self.max_entries:
+      self._release(self.index.popitem(last=False)[1])
+
+    while self.size > self.max_size:
+      if orphan := next((digest for digest, file in self.files.items() if not file["refs"]), None):
+        self._remove(orphan)
+      elif self.index:
+        self._release(self.index.popitem(last=False)[1])
+      else:
+        break
+
+  def getStats(self):
+    return {"entries": len(self.index), "files": len(self.files), "size": self.size, "hits": self.hits,
+            "misses": self.misses, "evictions": self.evictions}
+
+
+class IconProcessor:
+  def __init__(self, temp_dir, workers=ICON_WORKERS, queue_size=MAX_ICON_QUEUE):
+    self.temp_dir = temp_dir
+    self.queue_size = queue_size
+    self.queued = 0
+    self.pending = {}
+    self.cache = IconCache(temp_dir)
+    self.pool = ThreadPool(1, workers, "icons")
+
+    reactor.callWhenRunning(self.pool.start)
+    reactor.addSystemEventTrigger("during", "shutdown", self.pool.stop)
+
+  def process(self, icon):
+    key = self.cache.key(icon)
+
+    if item := self.cache.get(key):
+      return succeed(item)
+    elif key in self.pending:  # same icon already being processed
+      deferred = Deferred()
+      self.pending[key].append(deferred)
+      return deferred
+    elif self.queued >= self.queue_size:
+      raise ServiceUnavailableError()
+
+    self.queued += 1
+    self.pending[key] = []
+    deferred = deferToThreadPool(reactor, self.pool, self._process, icon)
+    deferred.addBoth(self._processed, key)
+
+    return deferred
+
+  def _processed(self, result, key):
+    self.queued -= 1
+    waiting = self.pending.pop(key)
+
+    if isinstance(result, Failure):
+      for deferred in waiting:
+        deferred.errback(result)
+    else:
+      self.cache.put(key, result)
+
+      for deferred in waiting:
+        deferred.callback(result)
+
+    return result
+
+  def _process(self, icon):  # runs in the worker pool, must not touch the reactor
+    handle, temp = mkstemp()
+    close(handle)
+
+    with Image.open(icon) as image:
+      if image.format != "PNG" or max(image.size) > MAX_ICON_SIZE:
+        image.thumbnail([MAX_ICON_SIZE] * 2, Resampling.LANCZOS)
+        image.save(temp, "PNG")
+      else:
+        copyfile(icon, temp)
+
+    with open(temp, "rb") as tmp:
+      digest = md5(tmp.read(), usedforsecurity=False).hexdigest()
+
+    path = join(self.temp_dir, digest)
+    move(temp, path)
+
+    return {"path": path, "digest": digest, "size": getsize(path)}
@@ -0,0 +1,125 @@
+from json import dumps
+from logging import Formatter, StreamHandler, getLogger
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from random import random
+from time import monotonic, time
+
+from twisted.internet import reactor
+
+
+TEXT = "text"
+JSON = "json"
+
+DEVICE = "device"
+ROUTE = "route"
+TRACE_SAMPLE = 1.0
+TRACE_RATE = 10
+TRACE_DURATION = 600
+
+
+class JsonFormatter(Formatter):
+  def __init__(self, timestamps=False):
+    super().__init__()
+    self.timestamps = timestamps
+
+  def format(self, record):
+    entry = {"level": record.levelname, "logger": record.name, "message": record.getMessage()}
+
+    if self.timestamps:
+      entry = {"time": self.formatTime(record), **entry}
+
+    if record.exc_info:
+      entry["exception"] = self.formatException(record.exc_info)
+
+    return dumps(entry, default=str)
+
+
+class Trace:
+  def __init__(self, sample=TRACE_SAMPLE, rate=TRACE_RATE, duration=TRACE_DURATION):
+    self.sample = sample
+    self.rate = rate  # messages per second
+    self.expires = time() + duration
+    self.tokens = rate
+    self.updated = monotonic()
+    self.logged = 0
+    self.skipped = 0
+
+  def allow(self):
+    now = monotonic()
+    self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+    if self.tokens < 1 or random() >= self.sample:
+      self.skipped += 1
+      return False
+
+    self.tokens -= 1
+    self.logged += 1
+
+    return True
+
+  def getInfo(self):
+    return {"sample": self.sample, "rate": self.rate, "expires": round(self.expires), "logged": self.logged,
+            "skipped": self.skipped}
+
+
+class Tracer:  # packet and request tracing at info level for a single device or route, without global debug
+  def __init__(self):
+    self.traces = {}  # (kind, key): trace
+
+  def enable(self, kind, key, sample=TRACE_SAMPLE, rate=TRACE_RATE, duration=TRACE_DURATION):
+    self.traces[kind, key] = Trace(sample, rate, duration)
+
+  def disable(self, kind, key):
+    return self.traces.pop((kind, key), None) is not None
+
+  def allow(self, kind, key):
+    if not self.traces or not (trace := self.traces.get((kind, key))):
+      return False
+    elif trace.expires < time():
+      del self.traces[kind, key]
+      return False
+
+    return trace.allow()
+
+  def allowRoute(self, uri):
+    if not self.traces:
+      return False
+
+    path = uri.split("?", 1)[0]
+
+    for kind, route in list(self.traces):
+      if kind == ROUTE and (path == route or path.startswith(route.rstrip("/") + "/")):
+        return self.allow(kind, route)
+
+    return False
+
+  def getTraces(self):
+    now = time()
+
+    for key in [key for key, trace in self.traces.items() if trace.expires < now]:
+      del self.traces[key]
+
+    return [{"kind": kind, "key": key, **trace.getInfo()} for (kind, key), trace in self.traces.items()]
+
+
+def setupLogging(level, timestamps=False, format_=TEXT):  # records are written from a thread, never the reactor
+  if format_ == JSON:
+    formatter = JsonFormatter(timestamps)
+  else:
+    formatter = Formatter(("%(asctime)s " if timestamps else "") + "%(levelname)s %(message)s")
+
+  handler = StreamHandler()
+  handler.setFormatter(formatter)
+
+  queue = SimpleQueue()
+  listener = QueueListener(queue, handler, respect_handler_level=True)
+  listener.start()
+  reactor.addSystemEventTrigger("after", "shutdown", listener.stop)
+
+  root = getLogger()
+  root.handlers = [QueueHandler(queue)]
+  root.setLevel(level)
+
+  return listener
@@ -0,0 +1,109 @@
+from bisect import bisect_left
+
+
+LATENCY_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0]
+REGISTRY = []
+
+
+def formatLabels(names, values):
+  if not names:
+    return ""
+
+  escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in values)
+  return "{" + ",".join(f"{name}=\"{value}\"" for name, value in zip(names, escaped)) + "}"
+
+
+def formatHistogram(name, names, values, buckets, counts, total, count):
+  lines = []
+  cumulative = 0
+
+  for bound, amount in zip([*map(str, buckets), "+Inf"], counts):
+    cumulative += amount
+    lines.append(f"{name}_bucket{formatLabels([*names, 'le'], [*values, bound])} {cumulative}")
+
+  lines.append(f"{name}_sum{formatLabels(names, values)} {total}")
+  lines.append(f"{name}_count{formatLabels(names, values)} {count}")
+
+  return lines
+
+
+class Metric:  # updated from the reactor thread only, plain dicts are enough
+  TYPE = None
+
+  def __init__(self, name, description, labels=()):
+    self.name = name
+    self.description = description
+    self.labels = labels
+    self.values = {} if labels else {(): 0}
+    REGISTRY.append(self)
+
+  def collect(self):
+    yield f"# HELP {self.name} {self.description}"
+    yield f"# TYPE {self.name} {self.TYPE}"
+
+    for values, value in self.values.items():
+      yield f"{self.name}{formatLabels(self.labels, values)} {value}"
+
+
+class Counter(Metric):
+  TYPE = "counter"
+
+  def inc(self, *values, amount=1):
+    self.values[values] = self.values.get(values, 0) + amount
+
+
+class Gauge(Metric):
+  TYPE = "gauge"
+
+  def inc(self, *values, amount=1):
+    self.values[values] = self.values.get(values, 0) + amount
+
+  def dec(self, *values, amount=1):
+    self.values[values] = self.values.get(values, 0) - amount
+
+
+class Histogram(Metric):
+  TYPE = "histogram"
+
+  def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+    super().__init__(name, description, labels)
+    self.values = {}
+    self.buckets = buckets
+
+  def observe(self, amount, *values):
+    if not (entry := self.values.get(values)):
+      entry = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    entry[0][bisect_left(self.buckets, amount)] += 1
+    entry[1] += amount
+    entry[2] += 1
+
+  def collect(self):
+    yield f"# HELP {self.name} {self.description}"
+    yield f"# TYPE {self.name} {self.TYPE}"
+
+    for values, (counts, total, count) in self.values.items():
+      yield from formatHistogram(self.name, self.labels, values, self.buckets, counts, total, count)
+
+
+def renderMetrics(*collectors):
+  lines = [line for metric in REGISTRY for line in metric.collect()]
+
+  for collector in collectors:
+    lines.extend(collector())
+
+  return ("\n".join(lines) + "\n").encode()
+
+
+PACKETS = Counter("konnect_packets_total", "Packets by direction and type", ["direction", "type"])
+BYTES = Counter("konnect_bytes_total", "Packet bytes by direction", ["direction"])
+CONNECTIONS = Counter("konnect_connections_total", "Device connections by event", ["event"])
+CONNECTED = Gauge("konnect_connected", "Open device connections")
+HANDSHAKES = Counter("konnect_tls_handshakes_total", "Completed TLS handshakes")
+IDENTITIES = Counter("konnect_udp_identities_total", "UDP identity packets by result", ["result"])
+REQUESTS = Counter("konnect_http_requests_total", "Admin API requests by route and status", ["route", "status"])
+LATENCY = Histogram("konnect_http_request_seconds", "Admin API latency by route", ["route"])
+TRANSFERS = Counter("konnect_transfers_total", "File transfers by direction and result", ["direction", "result"])
+LAG = Histogram("konnect_reactor_lag_seconds", "Delay of calls scheduled on the reactor")
+STALLS = Counter("konnect_reactor_stalls_total", "Times the reactor was blocked beyond the threshold")
+TRANSFERRED = Counter("konnect_transfer_bytes_total", "File transfer bytes by direction", ["direction"])
@@ -0,0 +1,113 @@
+import tracemalloc
+from cProfile import Profile
+from logging import warning
+from sys import _current_frames
+from threading import Event, Thread, get_ident
+from time import monotonic
+from traceback import format_stack
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from konnect.metrics import LAG, STALLS
+
+
+LAG_INTERVAL = 0.1
+LAG_THRESHOLD = 0.5
+MAX_STATS = 50
+
+
+class LagMonitor:  # how late the reactor runs a call scheduled every interval, and what blocked it
+  def __init__(self, interval=LAG_INTERVAL, threshold=LAG_THRESHOLD):
+    self.interval = interval
+    self.threshold = threshold
+    self.loop = LoopingCall(self._tick)
+    self.last = None
+    self.thread = None
+    self.stopped = Event()
+    self.stalled = False
+
+  def start(self):
+    self.thread = get_ident()
+    self.last = monotonic()
+    self.loop.start(self.interval, now=False)
+
+    if self.threshold:
+      Thread(target=self._watch, name="reactor-watchdog", daemon=True).start()
+
+    reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+  def stop(self):
+    self.stopped.set()
+
+    if self.loop.running:
+      self.loop.stop()
+
+  def _tick(self):
+    now = monotonic()
+    lag = max(now - self.last - self.interval, 0.0)
+    self.last = now
+    self.stalled = False
+    LAG.observe(lag)
+
+  def _watch(self):  # runs in its own thread, the reactor can't report on itself while blocked
+    while not self.stopped.wait(self.interval):
+      blocked = monotonic() - self.last - self.interval
+
+      if blocked > self.threshold and not self.stalled and (frame := _current_frames().get(self.thread)):
+        self.stalled = True
+        reactor.callFromThread(STALLS.inc)
+        stack = "".join(format_stack(frame))
+        warning(f"Reactor blocked for {blocked:.3f}s\n{stack}")
+
+
+class Profiler:
+  def __init__(self):
+    self.profile = None
+
+  def startCpu(self):
+    if self.profile:
+      return False
+
+    self.profile = Profile()
+    self.profile.enable()
+
+    return True
+
+  def stopCpu(self, limit=MAX_STATS):
+    if not self.profile:
+      return None
+
+    self.profile.disable()
+    self.profile.create_stats()
+    stats = sorted(self.profile.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    self.profile = None
+
+    return [{"function": f"{file}:{line}({name})", "calls": calls, "primitive": primitive, "time": time,
+             "cumulative": cumulative} for (file, line, name), (primitive, calls, time, cumulative, _) in stats]
+
+  def startMemory(self):
+    if tracemalloc.is_tracing():
+      return False
+
+    tracemalloc.start()
+
+    return True
+
+  def getMemory(self, limit=MAX_STATS):
+    if not tracemalloc.is_tracing():
+      return None
+
+    current, peak = tracemalloc.get_traced_memory()
+    stats = tracemalloc.take_snapshot().statistics("lineno")[:limit]
+
+    return {"current": current, "peak": peak, "allocations": [{"location": str(stat.traceback), "size": stat.size,
+                                                               "count": stat.count} for stat in stats]}
+
+  def stopMemory(self, limit=MAX_STATS):
+    memory = self.getMemory(limit)
+
+    if memory is not None:
+      tracemalloc.stop()
+
+    return memory
@@ -1,9 +1,23 @@
-from json import dumps
+from json import dumps, loads
 from re import sub
 from time import time
 from uuid import uuid4
 
 
+try:
+  from orjson import dumps as encode
+  from orjson import loads as decode
+except ImportError:
+  def encode(data):
+    return dumps(data, separators=(",", ":")).encode()
+
+  decode = loads
+
+
+MAX_TEMPLATES = 64
+TEMPLATES = {}  # key: (type, body, encoded packet without id), for packets that rarely change
+
+
 class PacketType:
   IDENTITY = "kdeconnect.identity"
   NOTIFICATION = "kdeconnect.notification"
@@ -17,11 +31,14 @@ class PacketType:
 
 
 class Packet:
+  __slots__ = ("data", "tail")
+
   PROTOCOL_VERSION = 8
   DEVICE_TYPE = "desktop"
 
   def __init__(self, type_=None):
     self.data = {}
+    self.tail = None
 
     if type_:
       self.data["id"] = round(time() * 1000)
@@ -29,12 +46,19 @@ class Packet:
       self.data["body"] = {}
 
   def __bytes__(self):
-    return dumps(self.data).encode()
+    if self.tail:  # only the id is spliced into a cached encoding
+      return b'{"id":%d,%s' % (self.data["id"], self.tail)
+
+    return encode(self.data)
 
   def __repr__(self):
     return f"Packet({self.data})"
 
   def set(self, key, value):
+    if self.tail:  # the body is shared with the template, copy it before writing
+      self.data["body"] = dict(self.data["body"])
+      self.tail = None
+
     self.data["body"][key] = value
 
   def has(self, key):
@@ -75,23 +99,44 @@ class Packet:
     return sub(r"[^A-Za-z0-9_]", "_", value)
 
   @staticmethod
-  def createIdentity(identifier, name, port, version=None):
-    packet = Packet(PacketType.IDENTITY)
-    packet.set("protocolVersion", version or Packet.PROTOCOL_VERSION)
-    packet.set("deviceId", identifier)
-    packet.set("deviceName", name)
-    packet.set("deviceType", Packet.DEVICE_TYPE)
-    packet.set("tcpPort", port)
-    packet.set("incomingCapabilities", [PacketType.PING, PacketType.NOTIFICATION_REQUEST,
-                                        PacketType.RUNCOMMAND_REQUEST, PacketType.RUNCOMMAND,
-                                        PacketType.SHARE])
-    packet.set("outgoingCapabilities", [PacketType.RING, PacketType.NOTIFICATION, PacketType.PING,
-                                        PacketType.RUNCOMMAND])
+  def saveTemplate(key, packet):
+    if len(TEMPLATES) >= MAX_TEMPLATES:
+      TEMPLATES.clear()
+
+    type_, body = packet.data["type"], dict(packet.data["body"])
+    TEMPLATES[key] = type_, body, encode({"type": type_, "body": body})[1:]
+
+  @staticmethod
+  def fromTemplate(key):
+    type_, body, tail = TEMPLATES[key]
+    packet = Packet()
+    packet.data = {"id": round(time() * 1000), "type": type_, "body": body}
+    packet.tail = tail
 
     return packet
 
   @staticmethod
-  def createPair(pairing):
+  def createIdentity(identifier, name, port, version=None):
+    key = (PacketType.IDENTITY, identifier, name, port, version)
+
+    if key not in TEMPLATES:
+      packet = Packet(PacketType.IDENTITY)
+      packet.set("protocolVersion", version or Packet.PROTOCOL_VERSION)
+      packet.set("deviceId", identifier)
+      packet.set("deviceName", name)
+      packet.set("deviceType", Packet.DEVICE_TYPE)
+      packet.set("tcpPort", port)
+      packet.set("incomingCapabilities", [PacketType.PING, PacketType.NOTIFICATION_REQUEST,
+                                          PacketType.RUNCOMMAND_REQUEST, PacketType.RUNCOMMAND,
+                                          PacketType.SHARE])
+      packet.set("outgoingCapabilities", [PacketType.RING, PacketType.NOTIFICATION, PacketType.PING,
+                                          PacketType.RUNCOMMAND])
+      Packet.saveTemplate(key, packet)
+
+    return Packet.fromTemplate(key)
+
+  @staticmethod
+  def createPair(pairing):  # timestamped, a template would only live for a second
     packet = Packet(PacketType.PAIR)
     packet.set("pair", pairing)
     packet.set("timestamp", round(time()))
@@ -134,7 +179,12 @@ class Packet:
 
   @staticmethod
   def createRing():
-    return Packet(PacketType.RING)
+    key = (PacketType.RING,)
+
+    if key not in TEMPLATES:
+      Packet.saveTemplate(key, Packet(PacketType.RING))
+
+    return Packet.fromTemplate(key)
 
   @staticmethod
   def createCommands(commands):
@@ -153,7 +203,10 @@ class Packet:
 
   @staticmethod
   def load(data):
+    if not isinstance(data, dict):
+      raise TypeError(f"Packet must be an object, not {type(data).__name__}")
+
     packet = Packet()
-    packet.data.update(data)
+    packet.data = data
 
     return packet
@@ -0,0 +1,198 @@
+from collections import deque
+from os import makedirs
+from os.path import isfile, join
+from statistics import mean, median, quantiles
+from time import perf_counter
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.internet.protocol import ClientFactory, Factory, Protocol
+from twisted.protocols.basic import LineReceiver
+
+from konnect.certificate import Certificate
+from konnect.packet import Packet, PacketType, decode
+
+
+MAX_REFERENCES = 100
+
+
+def summarize(samples):
+  if not samples:
+    return {"count": 0}
+
+  return {"count": len(samples), "mean": mean(samples), "p50": median(samples),
+          "p95": quantiles(samples, n=20, method="inclusive")[-1] if len(samples) > 1 else samples[0],
+          "max": max(samples)}
+
+
+def loadOptions(identifier, path):
+  makedirs(path, exist_ok=True)
+
+  if not isfile(join(path, Certificate.CERTIFICATE_FILE)):
+    Certificate.generate(identifier, path)
+
+  return Certificate.load_options(path)
+
+
+class FakePeer(LineReceiver):  # scripted device, identity -> tls -> accepts pairing, fetches payloads
+  delimiter = b"\n"
+  MAX_LENGTH = 1024 * 1024
+
+  def __init__(self, identifier, name, options, device="phone", fetch=True):
+    self.identifier = identifier
+    self.name = name
+    self.options = options
+    self.device = device
+    self.fetch = fetch
+    self.received = {}
+    self.waiting = []
+    self.handlers = {}
+    self.references = deque(maxlen=MAX_REFERENCES)  # notifications received, candidates for dismissal
+    self.secured = Deferred()
+    self.paired = Deferred()
+    self.closed = Deferred()
+
+  def send(self, type_, body=None):
+    packet = Packet(type_)
+    packet.data["body"] = body or {}
+    self.sendLine(bytes(packet))
+
+  def createIdentity(self):
+    packet = Packet(PacketType.IDENTITY)
+    packet.data["body"] = {
+      "deviceId": self.identifier, "deviceName": self.name, "deviceType": self.device,
+      "protocolVersion": Packet.PROTOCOL_VERSION, "tcpPort": 1716,
+      "incomingCapabilities": [PacketType.PING, PacketType.RING, PacketType.NOTIFICATION, PacketType.RUNCOMMAND,
+                               PacketType.RUNCOMMAND_REQUEST],
+      "outgoingCapabilities": [PacketType.PING, PacketType.NOTIFICATION_REQUEST, PacketType.RUNCOMMAND,
+                               PacketType.RUNCOMMAND_REQUEST, PacketType.SHARE]}
+
+    return packet
+
+  def sendIdentity(self):
+    self.sendLine(bytes(self.createIdentity()))
+
+  def sendPing(self):
+    self.send(PacketType.PING)
+
+  def requestNotifications(self):
+    self.send(PacketType.NOTIFICATION_REQUEST, {"request": True})
+
+  def dismiss(self, reference):
+    self.send(PacketType.NOTIFICATION_REQUEST, {"cancel": reference})
+
+  def requestCommands(self):
+    self.send(PacketType.RUNCOMMAND_REQUEST, {"requestCommandList": True})
+
+  def share(self, filename, data):  # fires with the seconds until the daemon finished reading the payload
+    sender = PayloadSender(data)
+    listener = reactor.listenSSL(0, Factory.forProtocol(lambda: sender), self.options, interface="127.0.0.1")
+    packet = Packet(PacketType.SHARE)
+    packet.set("filename", filename)
+    packet.data["payloadSize"] = len(data)
+    packet.data["payloadTransferInfo"] = {"port": listener.getHost().port}
+    self.sendLine(bytes(packet))
+
+    def stop(result):
+      listener.stopListening()
+      return result
+
+    return sender.finished.addBoth(stop)
+
+  def expect(self, type_, count=1):  # fires once count more packets of type_ arrived
+    deferred = Deferred()
+    self.waiting.append((type_, self.received.get(type_, 0) + count, deferred))
+    self._checkWaiting(type_)
+
+    return deferred
+
+  def connectionMade(self):
+    self.sendIdentity()
+    self.transport.startTLS(self.options, False)
+    self.sendIdentity()  # answered by the daemon once the connection is secure
+
+  def connectionLost(self, reason):
+    waiting, self.waiting = self.waiting, []
+
+    for _, _, deferred in waiting:
+      deferred.errback(reason)
+
+    self.closed.callback(self)
+
+  def lineReceived(self, line):
+    packet = Packet.load(decode(line))
+    type_ = packet.getType()
+    self.received[type_] = self.received.get(type_, 0) + 1
+
+    if type_ == PacketType.NOTIFICATION and not packet.get("isCancel"):
+      self.references.append(packet.get("id"))
+
+    if type_ == PacketType.IDENTITY and not self.secured.called:
+      self.secured.callback(self)
+    elif type_ == PacketType.PAIR and packet.get("pair") and not self.paired.called:
+      self.send(PacketType.PAIR, {"pair": True})
+      self.paired.callback(self)
+
+    if self.fetch and (info := packet.data.get("payloadTransferInfo")):
+      fetchPayload(self.transport.getPeer().host, info["port"], self.options, packet.data.get("payloadSize"))
+
+    if handler := self.handlers.get(type_):
+      handler(self, packet)
+
+    self._checkWaiting(type_)
+
+  def _checkWaiting(self, type_):
+    for item in [item for item in self.waiting if item[0] == type_ and self.received.get(type_, 0) >= item[1]]:
+      self.waiting.remove(item)
+
+      if not item[2].called:  # timed out or cancelled meanwhile
+        item[2].callback(self)
+
+
+class PayloadFetcher(Protocol):
+  def __init__(self, expected=None):
+    self.expected = expected
+    self.size = 0
+    self.start = perf_counter()
+    self.finished = Deferred()
+
+  def dataReceived(self, data):
+    self.size += len(data)
+
+    if self.expected and self.size >= self.expected:  # like a phone, instead of waiting for the sender to give up
+      self.transport.loseConnection()
+
+  def connectionLost(self, reason):
+    self.finished.callback((self.size, perf_counter() - self.start))
+
+
+class PayloadSender(Protocol):
+  def __init__(self, data):
+    self.data = data
+    self.start = perf_counter()
+    self.finished = Deferred()
+
+  def connectionMade(self):
+    self.start = perf_counter()
+    self.transport.write(self.data)
+    self.transport.loseConnection()
+
+  def connectionLost(self, reason):
+    if not self.finished.called:
+      self.finished.callback(perf_counter() - self.start)
+
+
+def fetchPayload(host, port, options, expected=None):  # fires with (bytes, seconds)
+  fetcher = PayloadFetcher(expected)
+  factory = ClientFactory.forProtocol(lambda: fetcher)
+  reactor.connectSSL(host, port, factory, options)
+
+  return fetcher.finished
+
+
+def connectPeer(host, port, peer):  # fires with the peer once the tls connection is established
+  deferred = connectProtocol(TCP4ClientEndpoint(reactor, host, port), peer)
+  deferred.addCallback(lambda _: peer.secured)
+
+  return deferred
@@ -1,38 +1,67 @@
-from json import loads
+from collections import deque
 from json.decoder import JSONDecodeError
-from logging import debug, error, exception, info, warning
+from logging import DEBUG, debug, error, exception, getLogger, info, warning
 from os import makedirs, remove
-from os.path import basename, expanduser, expandvars, getsize, isdir, isfile, join, splitext
+from os.path import basename, expanduser, expandvars, isdir, isfile, join, splitext
 from shutil import move
 from subprocess import Popen
 from tempfile import NamedTemporaryFile
 from time import time
 
 from twisted.internet import reactor
+from twisted.internet.interfaces import IHandshakeListener, IPushProducer
 from twisted.internet.protocol import ClientFactory, DatagramProtocol, Protocol
 from twisted.internet.reactor import callLater
 from twisted.internet.ssl import Certificate
-from twisted.protocols.basic import LineReceiver
+from twisted.protocols.basic import FileSender, LineReceiver
 from twisted.protocols.policies import TimeoutMixin
+from twisted.python.failure import Failure
+from zope.interface import implementer
 
-from konnect.packet import Packet, PacketType
+from konnect.logs import DEVICE
+from konnect.metrics import BYTES, CONNECTED, CONNECTIONS, HANDSHAKES, IDENTITIES, PACKETS, TRANSFERRED, TRANSFERS
+from konnect.packet import Packet, PacketType, decode
 
 
 MIN_TCP_PORT = 1716
 MAX_TCP_PORT = 1764
 DELAY_BETWEEN_PACKETS = 0.5
 BUFFER_SIZE = 8192
+CHUNK_SIZE = 16384
 TIMESTAMP_DIFFERENCE = 1800
+REPLAY_DELAY = 0.1
+REPLAY_INTERVAL = 0.5
+REPLAY_BATCH = 10
+MAX_QUEUE_BYTES = 1024 * 1024
+MAX_WRITE_BYTES = 65536
+TRANSFER_TIMEOUT = 30
+
+CONTROL = 0
+INTERACTIVE = 1
+BULK = 2
+PRIORITIES = {
+  PacketType.IDENTITY: CONTROL,
+  PacketType.PAIR: CONTROL,
+  PacketType.NOTIFICATION: BULK,
+}
+
+PACKET_TYPES = {value for name, value in vars(PacketType).items() if name.isupper()}  # anything else is "other"
+
+DROP = "drop"
+MERGE = "merge"
 
 NOT_PAIRED = 1
 REQUESTED = 2
 PAIRED = 3
 
 
+@implementer(IHandshakeListener)
 class Konnect(LineReceiver):
   delimiter = b"\n"
   status = NOT_PAIRED
   identifier = None
+  certificate = None
+  verified = None
   name = "unnamed"
   device = "unknown"
   timeout = None
@@ -41,24 +70,55 @@ class Konnect(LineReceiver):
 
   def __init__(self):
     self.address = None
+    self.replay = deque()
+    self.replaying = None
 
   def connectionMade(self):
     self.transport.setTcpKeepAlive(1)
+    self.queue = PacketQueue(self.transport, self.factory.queue_limit, self.factory.queue_policy, self._written,
+                             self._dropped)
+    self.transport.registerProducer(self.queue, True)
     self.factory.clients.add(self)
     peer = self.transport.getPeer()
     self.address = f"{peer.host}:{peer.port}"
     self.database = self.factory.database
+    CONNECTIONS.inc("accepted")
+    CONNECTED.inc()
 
   def connectionLost(self, reason):
     info(f"Device {self.name} disconnected")
-    self.factory.clients.remove(self)
+    CONNECTIONS.inc("dropped")
+    CONNECTED.dec()
+    self._cancelReplay()
+    self.queue.stopProducing()  # whatever is still queued never reached the device
+    self.factory.clients.discard(self)
+    self.factory.unregisterClient(self)
 
   def rawDataReceived(self, data):
     pass
 
-  def _sendPacket(self, data):
-    debug(f"SendTCP({self.address}, {self.isSecure()}) - {data}")
-    self.sendLine(bytes(data))
+  def _written(self, tag):  # a notification counts as delivered once written to the connection, a cancel as dismissed
+    reference, content = tag
+
+    if content is None:
+      self.factory.delivered.get(self.identifier, {}).pop(reference, None)
+      self.database.dismissNotification(self.identifier, reference)
+    else:
+      self.factory.delivered.setdefault(self.identifier, {})[reference] = content
+
+  def _dropped(self, tag):
+    self.factory.delivered.get(self.identifier, {}).pop(tag[0], None)
+
+  def _sendPacket(self, data, tag=None):
+    if getLogger().isEnabledFor(DEBUG):
+      debug(f"SendTCP({self.address}, {self.isSecure()}) - {data}")
+    elif self.factory.tracer.allow(DEVICE, self.identifier):
+      info(f"SendTCP({self.address}, {self.isSecure()}) - {data}")
+
+    PACKETS.inc("out", data.getType() if data.getType() in PACKET_TYPES else "other")
+    priority = PRIORITIES.get(data.getType(), INTERACTIVE)
+    key = (data.getType(), data.get("id")) if priority == BULK else None
+    self.queue.push(priority, bytes(data) + self.delimiter, key, tag)
 
   def sendRing(self):
     ring = Packet.createRing()
@@ -70,7 +130,7 @@ class Konnect(LineReceiver):
 
   def sendNotification(self, text, title, application, reference, payload=None):
     notification = Packet.createNotification(text, title, application, reference, payload)
-    self._sendPacket(notification)
+    self._sendPacket(notification, (reference, (text, title, application)))
 
   def sendCustom(self, data):
     data["id"] = data.get("id", round(time() * 1000))
@@ -81,12 +141,15 @@ class Konnect(LineReceiver):
 
   def sendCancel(self, reference):
     cancel = Packet.createCancel(reference)
-    self._sendPacket(cancel)
+    self._sendPacket(cancel, (reference, None))
 
   def sendCommands(self):
+    return self.database.listCommands(self.identifier).addCallback(self._sendCommands)
+
+  def _sendCommands(self, rows):
     commands = {}
 
-    for row in self.database.listCommands(self.identifier):
+    for row in rows:
       commands[row["key"]] = {"name": row["name"], "command": row["command"]}
 
     cmd = Packet.createCommands(commands)
@@ -111,7 +174,7 @@ class Konnect(LineReceiver):
     self.status = NOT_PAIRED
     pair = Packet.createPair(False)
     self._sendPacket(pair)
-    self.database.unpairDevice(self.identifier)
+    self.factory.unpairDevice(self.identifier)
 
   def _cancelTimeout(self):
     if self.timeout and self.timeout.active():
@@ -122,9 +185,11 @@ class Konnect(LineReceiver):
     return self.database.isDeviceTrusted(self.identifier)
 
   def _handleIdentity(self, packet):
+    self.factory.unregisterClient(self)
     self.identifier = packet.get("deviceId")
     self.name = packet.get("deviceName", "unnamed")
     self.device = packet.get("deviceType", "unknown")
+    self.factory.registerClient(self)
 
     if packet.get("protocolVersion") >= Packet.PROTOCOL_VERSION - 1:
       info("Starting client SSL (but I'm the server TCP socket)")
@@ -145,20 +210,19 @@ class Konnect(LineReceiver):
     if packet.get("pair"):
       if self.status == REQUESTED:
         info("Pair answer")
-        certificate = Certificate(self.transport.getPeerCertificate()).dumpPEM()
         self.status = PAIRED
 
         if self.isTrusted():
-          self.database.updateDevice(self.identifier, self.name, self.device)
+          self.factory.updateDevice(self)
         else:
-          self.database.pairDevice(self.identifier, certificate, self.name, self.device)
+          self.factory.pairDevice(self, self.certificate.dumpPEM())
       else:
         info("Pair request")
         pair = Packet.createPair(False)
 
         if self.status == PAIRED or self.isTrusted():
           info("I'm already paired, but they think I'm not")
-          self.database.updateDevice(self.identifier, self.name, self.device)
+          self.factory.updateDevice(self)
           pair.set("pair", True)
         else:
           info("Pairing started by the other end, rejecting their request")
@@ -171,62 +235,87 @@ class Konnect(LineReceiver):
         info("Canceled by other peer")
 
       self.status = NOT_PAIRED
-      self.database.unpairDevice(self.identifier)
+      self.factory.unpairDevice(self.identifier)
 
   def _handleNotify(self, packet):
     if packet.get("cancel"):
       reference = packet.get("cancel")
       debug(f"Dismiss notification request for {reference}")
+      self.factory.delivered.get(self.identifier, {}).pop(reference, None)
       self.database.dismissNotification(self.identifier, reference)
     elif packet.get("request"):
       info("Registered notifications listener")
-      self.database.updateDevice(self.identifier, self.name, self.device)
+      self.factory.updateDevice(self)
+      self.database.listNotifications(self.identifier).addCallback(self._replayNotifications)
+    else:
+      debug("Ignoring unknown request")
 
-      for notification in self.database.listNotifications(self.identifier):
-        reference = notification["reference"]
+  def _replayNotifications(self, notifications):
+    delivered = self.factory.delivered.get(self.identifier, {})
+    self._cancelReplay()
 
-        if int(notification["cancel"]):
-          text = notification["text"]
-          title = notification["title"]
-          application = notification["application"]
+    for notification in notifications:
+      reference = notification["reference"]
 
-          callLater(0.1, self.sendNotification, text, title, application, reference)
-        else:
-          self.sendCancel(reference)
-          self.database.dismissNotification(self.identifier, reference)
-    else:
-      debug("Ignoring unknown request")
+      if int(notification["cancel"]):  # the row goes once the cancel is written, a lost one is replayed next time
+        self.replay.append((self.sendCancel, reference))
+      else:
+        content = (notification["text"], notification["title"], notification["application"])
+
+        if delivered.get(reference) != content:  # only what the device hasn't seen yet
+          self.replay.append((self.sendNotification, *content, reference))
+
+    if self.replay:
+      debug(f"Replaying {len(self.replay)} notifications to {self.name}")
+      self.replaying = callLater(REPLAY_DELAY, self._replayNext)
+
+  def _replayNext(self):
+    for _ in range(min(REPLAY_BATCH, len(self.replay))):
+      method, *args = self.replay.popleft()
+      method(*args)
+
+    self.replaying = callLater(REPLAY_INTERVAL, self._replayNext) if self.replay else None
+
+  def _cancelReplay(self):
+    if self.replaying and self.replaying.active():
+      self.replaying.cancel()
+
+    self.replaying = None
+    self.replay.clear()
 
   def _handleCommand(self, packet):
     if not packet.get("commandList"):
       return
 
     try:
-      self.commands = loads(packet.get("commandList"))
+      self.commands = decode(packet.get("commandList"))
     except Exception:
       self.commands = {}
 
+    self.factory.updateCommands(self)
+
   def _handleCommandRequest(self, packet):
     if packet.get("requestCommandList"):
       self.sendCommands()
     elif packet.get("key"):
       key = packet.get("key")
-      command = self.database.getCommand(self.identifier, key)
-
-      if not command:
-        warning(f"{key} is not a configured command")
-      else:
-        info(f"Running: {command}")
-        Popen([command], shell=True)
+      self.database.getCommand(self.identifier, key).addCallback(self._runCommand, key)
     else:  # TODO setup?
       pass
 
+  def _runCommand(self, command, key):
+    if not command:
+      warning(f"{key} is not a configured command")
+    else:
+      info(f"Running: {command}")
+      Popen([command], shell=True)
+
   def _handleShare(self, packet):
     if not packet.get("filename") or not packet.data.get("payloadSize") or \
       not packet.data.get("payloadTransferInfo", {}).get("port"):
       return
 
-    if path := self.database.getPath(self.identifier):
+    if path := self.factory.getPath(self.identifier):
       factory = ClientFactory()
       factory.protocol = ShareReceive
       factory.filename = packet.get("filename")
@@ -239,6 +328,14 @@ class Konnect(LineReceiver):
   def isSecure(self):
     return self.transport.TLS
 
+  def handshakeCompleted(self):  # the peer certificate can't change afterwards, parse it only once
+    self.certificate = Certificate(self.transport.getPeerCertificate())
+    self.verified = self.certificate.getSubject().commonName.decode()
+    HANDSHAKES.inc()
+
+  def _countPacket(self, packet):  # only accepted packets, labelled by known type so peers can't add series
+    PACKETS.inc("in", packet.getType() if packet.getType() in PACKET_TYPES else "other")
+
   def lineReceived(self, line):
     if self.status == NOT_PAIRED and len(line) > BUFFER_SIZE:
       warning(f"Suspiciously long identity package received. Closing connection. {self.address}")
@@ -246,15 +343,21 @@ class Konnect(LineReceiver):
       return
 
     try:
-      data = loads(line)
+      data = decode(line)
       packet = Packet.load(data)
-      debug(f"RecvTCP({self.address}, {self.isSecure()}) - {packet}")
+
+      if getLogger().isEnabledFor(DEBUG):
+        debug(f"RecvTCP({self.address}, {self.isSecure()}) - {packet}")
+      elif self.factory.tracer.allow(DEVICE, self.identifier):
+        info(f"RecvTCP({self.address}, {self.isSecure()}) - {packet}")
     except (JSONDecodeError, TypeError) as e:
       error(f"Unserialization error: {line}")
       exception(e)
       self.transport.abortConnection()
       return
 
+    BYTES.inc("in", amount=len(line) + 1)
+
     # if not packet.isValid():
     #   warning("Ignoring malformed packet")
     #   self.transport.abortConnection()
@@ -262,22 +365,25 @@ class Konnect(LineReceiver):
 
     if not self.isSecure():
       if packet.isType(PacketType.IDENTITY):
+        self._countPacket(packet)
         self._handleIdentity(packet)
       else:
         warning(f"Device {self.name} not identified, ignoring non encrypted packet {packet.getType()}")
     else:
-      identifier = Certificate(self.transport.getPeerCertificate()).getSubject().commonName.decode()
-
-      if self.identifier != identifier:
-        warning(f"DeviceID in cert doesn't match deviceID in identity packet. {self.identifier} vs {identifier}")
+      if self.identifier != self.verified:
+        warning(f"DeviceID in cert doesn't match deviceID in identity packet. {self.identifier} vs {self.verified}")
         self.transport.abortConnection()
       elif packet.isType(PacketType.PAIR):
+        self._countPacket(packet)
         self._handlePairing(packet)
       elif packet.isType(PacketType.IDENTITY):  # and packet.get("protocolVersion") == Packet.PROTOCOL_VERSION:
+        self._countPacket(packet)
         identity = Packet.createIdentity(self.factory.identifier, self.factory.name,
                                          self.transport.getHost().port, packet.get("protocolVersion"))
         self._sendPacket(identity)
       elif self.isTrusted():
+        self._countPacket(packet)
+
         if packet.isType(PacketType.NOTIFICATION_REQUEST):
           self._handleNotify(packet)
         elif packet.isType(PacketType.PING):
@@ -297,6 +403,112 @@ class Konnect(LineReceiver):
         self._sendPacket(pair)
 
 
+@implementer(IPushProducer)
+class PacketQueue:
+  def __init__(self, transport, limit=MAX_QUEUE_BYTES, policy=MERGE, written=None, dropped=None):
+    self.transport = transport
+    self.limit = limit
+    self.policy = policy
+    self.onWritten = written  # called with the tag of entries written to the transport
+    self.onDropped = dropped  # called with the tag of entries that will never be written
+    self.queues = [deque() for _ in range(BULK + 1)]
+    self.keys = {}  # latest pending bulk packet by (type, id), replaced by a newer one when merging on overflow
+    self.size = 0
+    self.paused = False
+    self.flushing = None
+    self.sent = 0
+    self.dropped = 0
+    self.merged = 0
+
+  def push(self, priority, data, key=None, tag=None):
+    overflow = self.size + len(data) > self.limit
+
+    if overflow and key and self.policy == MERGE and (entry := self.keys.get(key)):  # newer content, same place
+      self.size += len(data) - len(entry[0])
+      entry[0] = data
+      entry[2] = tag
+      self.merged += 1
+    else:
+      entry = [data, key, tag]
+      self.queues[priority].append(entry)
+      self.size += len(data)
+
+      if key:
+        self.keys[key] = entry
+
+    for queue in reversed(self.queues[priority:]):  # oldest bulk first, never anything more urgent than the new entry
+      while self.size > self.limit and queue and queue[0] is not entry:
+        self._drop(queue.popleft())
+
+    if self.size > self.limit and priority == BULK:  # only more urgent packets left, the new one gives way
+      self.queues[BULK].remove(entry)
+      self._drop(entry)
+
+    if not self.flushing and not self.paused:  # coalesce everything queued during this reactor turn
+      self.flushing = callLater(0, self.flush)
+
+  def _remove(self, entry):
+    self.size -= len(entry[0])
+
+    if entry[1] and self.keys.get(entry[1]) is entry:
+      del self.keys[entry[1]]
+
+  def _drop(self, entry):
+    self._remove(entry)
+    self.dropped += 1
+
+    if entry[2] and self.onDropped:
+      self.onDropped(entry[2])
+
+  def flush(self):
+    self.flushing = None
+
+    while self.size and not self.paused:
+      chunk = []
+      length = 0
+
+      tags = []
+
+      for queue in self.queues:
+        while queue and length < MAX_WRITE_BYTES:
+          entry = queue.popleft()
+          self._remove(entry)
+          chunk.append(entry[0])
+          length += len(entry[0])
+
+          if entry[2]:
+            tags.append(entry[2])
+
+      self.sent += len(chunk)
+      BYTES.inc("out", amount=length)
+      self.transport.write(b"".join(chunk))
+
+      if self.onWritten:
+        for tag in tags:
+          self.onWritten(tag)
+
+  def pauseProducing(self):
+    self.paused = True
+
+  def resumeProducing(self):
+    self.paused = False
+    self.flush()
+
+  def stopProducing(self):
+    self.paused = True
+
+    if self.flushing and self.flushing.active():
+      self.flushing.cancel()
+
+    for queue in self.queues:
+      while queue:
+        self._drop(queue.popleft())
+
+  def getStats(self):
+    return {"bytes": self.size, "packets": sum(len(queue) for queue in self.queues), "sent": self.sent,
+            "dropped": self.dropped, "merged": self.merged}
+
+
 class Discovery(DatagramProtocol):
   def __init__(self, identifier, name, service_port):
     self.identifier = identifier
@@ -312,53 +524,99 @@ class Discovery(DatagramProtocol):
     try:
       packet = Packet.createIdentity(self.identifier, self.name, self.service_port, version)
       info("Broadcasting identity packet")
-      debug(f"SendUDP({address}:{MIN_TCP_PORT}) - {packet}")
+
+      if getLogger().isEnabledFor(DEBUG):
+        debug(f"SendUDP({address}:{MIN_TCP_PORT}) - {packet}")
+
       self.transport.write(bytes(packet), (address, MIN_TCP_PORT))
     except OSError:
       warning("Failed to broadcast identity packet")
 
   def datagramReceived(self, datagram, addr):
     try:
-      data = loads(datagram)
+      data = decode(datagram)
       packet = Packet.load(data)
-      debug(f"RecvUDP({addr[0]}:{addr[1]}) - {packet}")
+
+      if getLogger().isEnabledFor(DEBUG):
+        debug(f"RecvUDP({addr[0]}:{addr[1]}) - {packet}")
     except (JSONDecodeError, TypeError) as e:
       error(f"Unserialization error: {datagram}")
       exception(e)
+      IDENTITIES.inc("invalid")
       return
 
     now = time()
 
     if not packet.isType(PacketType.IDENTITY):
       info(f"Received a UDP packet of wrong type {packet.getType()}")
+      IDENTITIES.inc("wrong_type")
     elif packet.get("deviceId") == self.identifier:
       debug("Ignoring my own broadcast")
+      IDENTITIES.inc("own")
     elif self.last_packets.get(packet.get("deviceId"), 0) + DELAY_BETWEEN_PACKETS > now:
       debug(f"Discarding second UDP packet from the same device {packet.get('deviceId')} received too quickly")
+      IDENTITIES.inc("too_fast")
     elif int(packet.get("tcpPort", 0)) < MIN_TCP_PORT or int(packet.get("tcpPort", 0)) > MAX_TCP_PORT:
       debug("TCP port outside of kdeconnect's range")
+      IDENTITIES.inc("bad_port")
     elif Packet.PROTOCOL_VERSION - 1 > packet.get("protocolVersion", 0):
       info(f"Refusing to connect to a device using an older protocol version. Ignoring {packet.get('deviceId')}")
+      IDENTITIES.inc("old_version")
     else:
+      IDENTITIES.inc("accepted")
       self.last_packets[packet.get("deviceId")] = now
       debug(f"Received UDP identity packet from {addr[0]}, trying reverse connection")
       self.announceIdentity(addr[0], packet.get("protocolVersion"))
 
 
 class ShareSend(Protocol, TimeoutMixin):
-  def __del__(self):
-    callLater(1, self.factory._stopListener, self.factory.port)
+  file = None
 
   def connectionMade(self):
-    address = f"{self.transport.getPeer().host}:{self.transport.getPeer().port}"
-    debug(f"Transfer({address}) - File({basename(self.factory.path)}, {getsize(self.factory.path)})")
+    self.setTimeout(TRANSFER_TIMEOUT)  # only a stalled transfer, every chunk sent restarts it
+    peer = self.transport.getPeer()
+    payload = self.factory.claimPayload(self.transport.getHost().port, peer.host)
+
+    if not payload:
+      warning(f"Transfer({peer.host}:{peer.port}) - No pending payload, closing connection")
+      self.transport.abortConnection()
+      return
+
+    debug(f"Transfer({peer.host}:{peer.port}) - File({basename(payload['path'])}, {payload['size']})")
+
+    try:
+      self.file = open(payload["path"], "rb")
+    except OSError:
+      warning(f"Transfer({peer.host}:{peer.port}) - Payload {payload['digest']} no longer available")
+      self.transport.abortConnection()
+      return
+
+    sender = FileSender()
+    sender.CHUNK_SIZE = CHUNK_SIZE
+    # pull producer, the transport asks for the next chunk once its buffer is drained
+    sender.beginFileTransfer(self.file, self.transport, self._chunkSent).addBoth(self._transferFinished)
+
+  def _chunkSent(self, chunk):
+    self.resetTimeout()
+    return chunk
+
+  def _transferFinished(self, result):
+    TRANSFERS.inc("out", "failed" if isinstance(result, Failure) else "completed")
 
-    with open(self.factory.path, "rb") as f:
-      while chunk := f.read(16384):
-        self.transport.write(chunk)
+    if self.file and not self.file.closed:
+      TRANSFERRED.inc("out", amount=self.file.tell())
 
+    self._closeFile()
     self.setTimeout(1)
 
+  def _closeFile(self):
+    if self.file and not self.file.closed:
+      self.file.close()
+
+  def connectionLost(self, reason):
+    self._closeFile()
+    self.setTimeout(None)
+
   def timeoutConnection(self):
     try:
       self.transport.abortConnection()
@@ -373,8 +631,11 @@ class ShareReceive(Protocol, TimeoutMixin):
 
   def dataReceived(self, data):
     self.tempname.write(data)
+    TRANSFERRED.inc("in", amount=len(data))
 
   def connectionLost(self, reason):
+    TRANSFERS.inc("in", "completed" if self.tempname.tell() == self.factory.payloadSize else "failed")
+
     if self.tempname.tell() == self.factory.payloadSize:
       if not isdir(self.factory.path):
         makedirs(self.factory.path, exist_ok=True)
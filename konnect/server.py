@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from argparse import SUPPRESS, ArgumentDefaultsHelpFormatter, ArgumentParser
-from logging import DEBUG, INFO, WARNING, basicConfig, getLogger, info
+from logging import DEBUG, INFO, WARNING, getLogger, info
 from os import makedirs
 from os.path import expanduser, expandvars, join
 from platform import node
@@ -15,19 +15,15 @@ from konnect import __version__
 from konnect.api import API
 from konnect.certificate import Certificate
 from konnect.database import Database
-from konnect.factories import KonnectFactory
-from konnect.protocols import MAX_TCP_PORT, Discovery
+from konnect.factories import MIN_XFER_PORT, XFER_PORTS, KonnectFactory, TransferFactory
+from konnect.logs import JSON, TEXT, setupLogging
+from konnect.monitor import LAG_THRESHOLD, LagMonitor
+from konnect.protocols import DROP, MAX_QUEUE_BYTES, MAX_TCP_PORT, MERGE, Discovery
 
 
 def start(args):
   level = DEBUG if args.debug else INFO
-
-  format_ = "%(levelname)s %(message)s"
-
-  if args.timestamps:
-    format_ = "%(asctime)s " + format_
-
-  basicConfig(format=format_, level=level)
+  setupLogging(level, args.timestamps, args.log_format)
 
   getLogger("PIL").setLevel(WARNING)
 
@@ -51,20 +47,23 @@ def start(args):
     context = options.getContext()
     context.set_keylog_callback(keylog)
 
-  konnect = KonnectFactory(database, identifier, args.name, options)
+  konnect = KonnectFactory(database, identifier, args.name, options, args.queue_limit, args.queue_policy)
   discovery = Discovery(identifier, args.name, args.service_port)
+  transfers = TransferFactory(options, args.transfer_port, args.transfer_ports)
 
   info(f"Starting Konnectd {__version__} as {args.name}")
 
   reactor.listenTCP(args.service_port, konnect, interface="0.0.0.0")
   reactor.listenUDP(args.discovery_port, discovery, interface="0.0.0.0")
-  site = Site(API(konnect, discovery, database, args.debug))
+  transfers.startListening()
+  site = Site(API(konnect, discovery, transfers, database, args.debug))
 
   if args.admin_port.isdigit():
     reactor.listenTCP(int(args.admin_port), site, interface="127.0.0.1")
   else:
     reactor.listenUNIX(expanduser(expandvars(args.admin_port)), site)
 
+  reactor.callWhenRunning(LagMonitor(threshold=args.lag_threshold).start)
   reactor.run()
 
 
@@ -74,9 +73,15 @@ def main():
   parser.add_argument("--debug", action="store_true", default=False, help="Show debug messages")
   parser.add_argument("--discovery-port", metavar="PORT", default=MAX_TCP_PORT, type=int, help="Discovery port")
   parser.add_argument("--service-port", metavar="PORT", default=MAX_TCP_PORT, type=int, help="Service port")
+  parser.add_argument("--transfer-port", metavar="PORT", default=MIN_XFER_PORT, type=int, help="First port tried for payload transfers")
+  parser.add_argument("--transfer-ports", metavar="COUNT", default=XFER_PORTS, type=int, help="Payload transfer ports kept open, one pending payload per device each")
   parser.add_argument("--admin-port", metavar="PORT", default="8080", type=str, help="API (tcp) port or unix socket")
   parser.add_argument("--config-dir", metavar="DIR", default="~/.config/konnect", help="Config directory")
   parser.add_argument("--timestamps", action="store_true", default=False, help="Show timestamps")
+  parser.add_argument("--log-format", choices=[TEXT, JSON], default=TEXT, help="Log messages format")
+  parser.add_argument("--lag-threshold", metavar="SECONDS", default=LAG_THRESHOLD, type=float, help="Log the stack when blocked longer (0 disables)")
+  parser.add_argument("--queue-limit", metavar="BYTES", default=MAX_QUEUE_BYTES, type=int, help="Outgoing bytes queued per device, oldest notifications are dropped first")
+  parser.add_argument("--queue-policy", choices=[DROP, MERGE], default=MERGE, help="Over the limit: merge updates queued notifications in place before dropping, drop only drops")
   parser.add_argument("--sslkeylog", action="store", default=None, const="~/sslkey.log", nargs="?", help=SUPPRESS)
   parser.add_argument("--version", action="store_true", help="Version information")
   parser.add_argument("--help", action="store_true", help=SUPPRESS)
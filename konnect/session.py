@@ -0,0 +1,210 @@
+from http.client import HTTPConnection, HTTPException, RemoteDisconnected
+from json import dumps, loads
+from os.path import expanduser, expandvars
+from socket import AF_UNIX, SOCK_STREAM, socket
+from threading import Lock
+from urllib.parse import quote_plus
+
+from konnect.exceptions import ApiError
+
+
+TIMEOUT = 60
+POOL_SIZE = 4
+HEADERS = {"Content-Type": "application/json"}
+
+
+class UnixHTTPConnection(HTTPConnection):  # admin interface listening on a unix socket
+  def __init__(self, path, timeout=TIMEOUT):
+    super().__init__("localhost", timeout=timeout)
+    self.path = path
+
+  def connect(self):
+    self.sock = socket(AF_UNIX, SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.path)
+
+
+def connect(port, timeout=TIMEOUT):
+  if str(port).isdigit():
+    return HTTPConnection("localhost", int(port), timeout=timeout)
+
+  return UnixHTTPConnection(expanduser(expandvars(port)), timeout)
+
+
+def quote(item):  # keeps the @name and =key prefixes
+  return quote_plus(item, safe="@=")
+
+
+def parse(status, type_, content):
+  if not (type_ or "").startswith("application/json"):
+    return content.decode()
+
+  data = loads(content) if content else {}
+
+  if not data.get("success", status < 400):
+    raise ApiError(data.get("message", "unknown error"), status, data.get("exception"))
+
+  return data
+
+
+class Routes:  # one method per api route, request() comes from the sync or asyncio session
+  def info(self):
+    return self.request("GET", "/")
+
+  def announce(self):
+    return self.request("PUT", "/")
+
+  def version(self):
+    return self.request("GET", "/version")
+
+  def database(self):
+    return self.request("GET", "/database")
+
+  def metrics(self):
+    return self.request("GET", "/metrics")
+
+  def devices(self):
+    return self.request("GET", "/device")
+
+  def device(self, device):
+    return self.request("GET", f"/device/{quote(device)}")
+
+  def pair(self, device):
+    return self.request("POST", f"/pair/{quote(device)}")
+
+  def unpair(self, device):
+    return self.request("DELETE", f"/pair/{quote(device)}")
+
+  def ping(self, device):
+    return self.request("POST", f"/ping/{quote(device)}")
+
+  def ring(self, device):
+    return self.request("POST", f"/ring/{quote(device)}")
+
+  def notifications(self):
+    return self.request("GET", "/notification")
+
+  def notify(self, device, text, title, application, reference=None, icon=None):
+    data = {"text": text, "title": title, "application": application, "reference": reference, "icon": icon}
+    return self.request("POST", f"/notification/{quote(device)}", data)
+
+  def notifyMany(self, notifications, devices="*"):  # list of notify() arguments, to a list of devices or all
+    return self.request("POST", "/notification", {"notifications": notifications, "devices": devices})
+
+  def cancel(self, device, reference):
+    return self.request("DELETE", f"/notification/{quote(device)}/{quote(reference)}")
+
+  def commands(self, device=None):
+    return self.request("GET", f"/command/{quote(device)}" if device else "/command")
+
+  def addCommand(self, device, name, command):
+    return self.request("POST", f"/command/{quote(device)}", {"name": name, "command": command})
+
+  def updateCommand(self, device, key, name, command):
+    return self.request("PUT", f"/command/{quote(device)}/{quote(key)}", {"name": name, "command": command})
+
+  def deleteCommand(self, device, key=None):  # without a key every command of the device
+    return self.request("DELETE", f"/command/{quote(device)}/{quote(key)}" if key else f"/command/{quote(device)}")
+
+  def execute(self, device, key):
+    return self.request("PATCH", f"/command/{quote(device)}/{quote(key)}")
+
+  def share(self, device, path):  # None stops receiving files
+    return self.request("PATCH", f"/share/{quote(device)}", {"path": path})
+
+  def custom(self, device, packet):
+    return self.request("POST", f"/custom/{quote(device)}", packet)
+
+  def traces(self):
+    return self.request("GET", "/trace")
+
+  def traceRoute(self, route, **options):  # sample, rate, duration
+    return self.request("PUT", "/trace", {"route": route, **options})
+
+  def untraceRoute(self, route):
+    return self.request("DELETE", "/trace", {"route": route})
+
+  def traceDevice(self, device, **options):
+    return self.request("PUT", f"/trace/{quote(device)}", options)
+
+  def untraceDevice(self, device):
+    return self.request("DELETE", f"/trace/{quote(device)}")
+
+  def startProfile(self):
+    return self.request("PUT", "/profile")
+
+  def stopProfile(self):
+    return self.request("DELETE", "/profile")
+
+  def startMemory(self):
+    return self.request("PUT", "/memory")
+
+  def memory(self):
+    return self.request("GET", "/memory")
+
+  def stopMemory(self):
+    return self.request("DELETE", "/memory")
+
+
+class Session(Routes):  # keep-alive connections reused across calls and threads
+  def __init__(self, port="8080", size=POOL_SIZE, timeout=TIMEOUT):
+    self.port = port
+    self.size = size
+    self.timeout = timeout
+    self.idle = []
+    self.lock = Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def close(self):
+    with self.lock:
+      idle, self.idle = self.idle, []
+
+    for connection in idle:
+      connection.close()
+
+  def _acquire(self):
+    with self.lock:
+      if self.idle:
+        return self.idle.pop(), True
+
+    return connect(self.port, self.timeout), False
+
+  def _release(self, connection):
+    with self.lock:
+      if len(self.idle) < self.size:
+        self.idle.append(connection)
+        return
+
+    connection.close()
+
+  def request(self, method, uri, data=None):
+    body = dumps(data or {})
+
+    while True:
+      connection, reused = self._acquire()
+
+      try:
+        connection.request(method, uri, body, HEADERS)
+        response = connection.getresponse()
+        content = response.read()
+        break
+      except (RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        connection.close()
+
+        if not reused:  # an idle connection may have been closed by the server, a new one shouldn't
+          raise
+      except (OSError, HTTPException):
+        connection.close()
+        raise
+
+    if response.will_close:
+      connection.close()
+    else:
+      self._release(connection)
+
+    return parse(response.status, response.getheader("content-type"), content)
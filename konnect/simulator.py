@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from io import BytesIO
+from json import dumps
+from logging import WARNING, warning
+from os import urandom
+from os.path import expanduser, expandvars, join
+from random import choices, expovariate
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from uuid import uuid4
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.internet.error import CannotListenError
+from twisted.internet.protocol import DatagramProtocol
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgentEndpointFactory
+from zope.interface import implementer
+
+from konnect.certificate import Certificate
+from konnect.logs import setupLogging
+from konnect.packet import Packet, PacketType, decode
+from konnect.peer import FakePeer, connectPeer, loadOptions, summarize
+from konnect.protocols import MAX_TCP_PORT, MIN_TCP_PORT
+
+
+HOST = "127.0.0.1"
+TIMEOUT = 10
+OPERATIONS = ["ping", "notification", "request", "dismiss", "share", "command"]
+DEFAULT_MIX = "ping=4,notification=2,request=1,dismiss=1,share=1,command=1"
+
+
+@implementer(IAgentEndpointFactory)
+class SocketEndpoints:
+  def __init__(self, path):
+    self.path = path
+
+  def endpointForURI(self, uri):
+    return UNIXClientEndpoint(reactor, self.path)
+
+
+class AdminClient:  # admin api of the daemon under test, over tcp or unix socket
+  def __init__(self, port):
+    self.pool = HTTPConnectionPool(reactor)
+
+    if port.isdigit():
+      self.base = f"http://{HOST}:{port}"
+      self.agent = Agent(reactor, pool=self.pool)
+    else:
+      self.base = "http://localhost"
+      self.agent = Agent.usingEndpointFactory(reactor, SocketEndpoints(expanduser(expandvars(port))), self.pool)
+
+  def request(self, method, uri, body=None):
+    producer = FileBodyProducer(BytesIO(dumps(body or {}).encode()))
+    deferred = self.agent.request(method.encode(), (self.base + uri).encode(),
+                                  Headers({"content-type": ["application/json"]}), producer)
+
+    return deferred.addCallback(self._response)
+
+  def _response(self, response):
+    def check(body):
+      if response.code >= 300:
+        raise RuntimeError(f"HTTP {response.code}: {body.decode()}")
+
+      return decode(body)
+
+    return readBody(response).addCallback(check)
+
+
+class Announcements(DatagramProtocol):  # the daemon answers udp identities on MIN_TCP_PORT of the sender
+  def __init__(self):
+    self.waiting = []
+
+  def discover(self, packet, port):
+    deferred = Deferred()
+    self.waiting.append(deferred)
+    self.transport.write(bytes(packet), (HOST, port))
+
+    return deferred
+
+  def datagramReceived(self, datagram, addr):
+    try:
+      packet = Packet.load(decode(datagram))
+    except (ValueError, TypeError):
+      return
+
+    if packet.isType(PacketType.IDENTITY) and self.waiting:
+      self.waiting.pop(0).callback(packet.get("tcpPort"))
+
+
+class Stats:
+  def __init__(self):
+    self.operations = {}
+
+  def _entry(self, operation):
+    return self.operations.setdefault(operation, {"count": 0, "errors": 0, "latencies": []})
+
+  def success(self, operation, latency=None):
+    entry = self._entry(operation)
+    entry["count"] += 1
+
+    if latency is not None:
+      entry["latencies"].append(latency)
+
+  def failure(self, operation):
+    entry = self._entry(operation)
+    entry["count"] += 1
+    entry["errors"] += 1
+
+  def report(self):
+    return {operation: {"count": entry["count"], "errors": entry["errors"],
+                        "error_rate": entry["errors"] / entry["count"] if entry["count"] else 0.0,
+                        "latency": summarize(entry["latencies"])}
+            for operation, entry in self.operations.items()}
+
+
+class VirtualDevice:
+  def __init__(self, simulator, index, options):
+    self.simulator = simulator
+    self.index = index
+    self.options = options
+    self.identifier = Certificate.extract_identifier(options)
+    self.peer = FakePeer(self.identifier, f"sim{index}", options)
+    self.stats = Stats()
+    self.call = None
+    self.running = False
+    self.shares = 0
+
+  def _timed(self, operation, deferred):
+    start = perf_counter()
+
+    def succeeded(result):
+      self.stats.success(operation, perf_counter() - start)
+      return result
+
+    def failed(failure):
+      self.stats.failure(operation)
+      return failure
+
+    return deferred.addTimeout(TIMEOUT, reactor).addCallbacks(succeeded, failed)
+
+  @inlineCallbacks
+  def setup(self):
+    args = self.simulator.args
+    port = args.service_port
+
+    try:
+      if not port:
+        announced = self.simulator.announcements.discover(self.peer.createIdentity(), args.discovery_port)
+        port = yield self._timed("discovery", announced)
+
+      yield self._timed("connect", connectPeer(HOST, port, self.peer))
+
+      start = perf_counter()
+      pong = self.peer.expect(PacketType.PING)
+      yield self.simulator.admin.request("POST", f"/pair/{self.identifier}")
+      yield self.peer.paired.addTimeout(TIMEOUT, reactor)
+      self.peer.sendPing()
+      yield pong.addTimeout(TIMEOUT, reactor)
+      self.stats.success("pair", perf_counter() - start)
+
+      yield self.simulator.admin.request("PATCH", f"/share/{self.identifier}", {"path": self.simulator.path})
+    except Exception as e:
+      self.stats.failure("setup")
+      warning(f"Device {self.index} failed to setup: {e}")
+      return False
+
+    return True
+
+  def start(self):
+    self.running = True
+    self._schedule()
+
+  def stop(self):
+    self.running = False
+
+    if self.call and self.call.active():
+      self.call.cancel()
+
+  def _schedule(self):
+    if self.running:
+      self.call = reactor.callLater(expovariate(self.simulator.args.rate), self._operate)
+
+  def _operate(self):
+    operation = choices(OPERATIONS, self.simulator.weights)[0]
+
+    try:
+      if deferred := getattr(self, "_" + operation)():
+        deferred.addErrback(lambda _: None)  # already counted as an error
+    except Exception:
+      self.stats.failure(operation)
+
+    self._schedule()
+
+  def _ping(self):
+    pong = self.peer.expect(PacketType.PING)
+    self.peer.sendPing()
+
+    return self._timed("ping", pong)
+
+  def _notification(self):
+    received = self.peer.expect(PacketType.NOTIFICATION)
+    created = self.simulator.admin.request("POST", f"/notification/{self.identifier}",
+                                           {"text": "text", "title": "title", "application": "simulator"})
+    created.addErrback(lambda _: received.cancel())
+
+    return self._timed("notification", received)
+
+  def _request(self):
+    self.peer.requestNotifications()
+    self.stats.success("request")
+
+  def _dismiss(self):
+    if self.peer.references:
+      self.peer.dismiss(self.peer.references.popleft())
+      self.stats.success("dismiss")
+
+  def _share(self):
+    self.shares += 1
+    return self._timed("share", self.peer.share(f"sim{self.index}-{self.shares}.bin", self.simulator.payload))
+
+  def _command(self):
+    commands = self.peer.expect(PacketType.RUNCOMMAND)
+    self.peer.requestCommands()
+
+    return self._timed("command", commands)
+
+  @inlineCallbacks
+  def teardown(self, unpair):
+    if unpair and self.peer.paired.called:
+      try:
+        yield self.simulator.admin.request("DELETE", f"/pair/{self.identifier}")
+      except Exception as e:
+        warning(f"Device {self.index} failed to unpair: {e}")
+
+    if self.peer.transport:
+      self.peer.transport.loseConnection()
+
+
+class Simulator:
+  def __init__(self, args, path, announcements):
+    self.args = args
+    self.path = path
+    self.admin = AdminClient(args.admin_port)
+    self.announcements = announcements
+    self.weights = parseMix(args.mix)
+    self.payload = urandom(args.share_size * 1024)
+    self.devices = []
+
+  @inlineCallbacks
+  def run(self):
+    certificates = expanduser(expandvars(self.args.cert_dir)) if self.args.cert_dir else join(self.path, "certificates")
+
+    for index in range(self.args.devices):  # key generation happens before any traffic
+      self.devices.append(VirtualDevice(self, index, loadOptions(uuid4().hex, join(certificates, f"device{index}"))))
+
+    setups = []
+
+    for device in self.devices:
+      setups.append(device.setup())
+      yield task.deferLater(reactor, 1 / self.args.ramp, lambda: None)
+
+    results = yield DeferredList(setups)
+    ready = [device for device, (_, success) in zip(self.devices, results) if success]
+
+    for device in ready:
+      device.start()
+
+    yield task.deferLater(reactor, self.args.duration, lambda: None)
+
+    for device in ready:
+      device.stop()
+
+    yield task.deferLater(reactor, 1, lambda: None)  # let in flight operations finish
+    yield DeferredList([device.teardown(not self.args.keep) for device in self.devices])
+    yield self.admin.pool.closeCachedConnections()
+
+    return self.report(len(ready))
+
+  def report(self, ready):
+    devices = {device.identifier: device.stats.report() for device in self.devices}
+    total = Stats()
+
+    for device in self.devices:
+      for operation, entry in device.stats.operations.items():
+        merged = total._entry(operation)
+        merged["count"] += entry["count"]
+        merged["errors"] += entry["errors"]
+        merged["latencies"].extend(entry["latencies"])
+
+    return {"parameters": vars(self.args), "devices": self.args.devices, "ready": ready, "total": total.report(),
+            "per_device": devices}
+
+
+def parseMix(mix):
+  weights = dict.fromkeys(OPERATIONS, 0)
+
+  for item in mix.split(","):
+    operation, _, weight = item.partition("=")
+
+    if operation.strip() not in weights:
+      raise ValueError(f"unknown operation {operation}, expected one of {', '.join(OPERATIONS)}")
+
+    weights[operation.strip()] = float(weight or 1)
+
+  return [weights[operation] for operation in OPERATIONS]
+
+
+def start(reactor_, args, announcements):
+  directory = TemporaryDirectory(prefix="konnect-simulator-")
+  deferred = Simulator(args, directory.name, announcements).run()
+
+  def save(results):
+    output = dumps(results, indent=2)
+
+    if args.output:
+      with open(args.output, "w") as handle:
+        handle.write(output + "\n")
+    else:
+      print(output)
+
+  deferred.addCallback(save)
+  deferred.addBoth(lambda result: directory.cleanup() or result)
+
+  return deferred
+
+
+def main():
+  parser = ArgumentParser(prog="konnect-simulator", formatter_class=ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--devices", metavar="COUNT", default=100, type=int, help="Virtual devices")
+  parser.add_argument("--discovery-port", metavar="PORT", default=MAX_TCP_PORT, type=int, help="Daemon discovery port")
+  parser.add_argument("--service-port", metavar="PORT", default=None, type=int, help="Daemon service port (skips discovery)")
+  parser.add_argument("--admin-port", metavar="PORT", default="8080", type=str, help="Daemon API (tcp) port or unix socket")
+  parser.add_argument("--duration", metavar="SECONDS", default=30, type=float, help="Traffic duration")
+  parser.add_argument("--rate", metavar="OPS", default=1.0, type=float, help="Operations per second per device")
+  parser.add_argument("--ramp", metavar="DEVICES", default=20, type=float, help="Devices connected per second")
+  parser.add_argument("--mix", default=DEFAULT_MIX, help="Operation weights")
+  parser.add_argument("--share-size", metavar="KIB", default=64, type=int, help="Shared file size")
+  parser.add_argument("--cert-dir", metavar="DIR", default=None, help="Keep device certificates between runs")
+  parser.add_argument("--keep", action="store_true", default=False, help="Don't unpair devices when finished")
+  parser.add_argument("--output", metavar="FILE", default=None, help="Save results to file instead of stdout")
+
+  args = parser.parse_args()
+  announcements = Announcements()
+
+  try:
+    parseMix(args.mix)
+  except ValueError as e:
+    parser.error(str(e))
+
+  if not args.service_port:
+    try:
+      reactor.listenUDP(MIN_TCP_PORT, announcements, interface=HOST)
+    except CannotListenError:
+      parser.error(f"udp port {MIN_TCP_PORT} is in use, pass --service-port to skip discovery")
+
+  setupLogging(WARNING)
+  task.react(start, [args, announcements])
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,30 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from twisted.internet import reactor
+
+
+class ManualReactor:  # startup and shutdown triggers are left to the test, anything else reaches the reactor
+  def callWhenRunning(self, *args, **kwargs):
+    pass
+
+  def addSystemEventTrigger(self, *args, **kwargs):
+    pass
+
+  def __getattr__(self, name):
+    return getattr(reactor, name)
+
+
+class FakeClient:  # just what the factory reads from a connected device
+  def __init__(self, identifier, name, device="phone"):
+    self.identifier = identifier
+    self.name = name
+    self.device = device
+    self.commands = {}
+
+
+def temporaryPath(test, name=""):  # removed after the test, trial's mktemp() would write below the working directory
+  directory = TemporaryDirectory(prefix="konnect-tests-")
+  test.addCleanup(directory.cleanup)
+
+  return join(directory.name, name)
@@ -0,0 +1,183 @@
+from json import dumps, loads
+
+from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.internet.testing import StringTransport
+from twisted.trial.unittest import TestCase
+from twisted.web.http import HTTPChannel
+from twisted.web.server import Site
+
+from konnect import database, icons
+from konnect.api import API
+from konnect.database import Database
+from konnect.factories import KonnectFactory, TransferFactory
+from tests.helpers import FakeClient, ManualReactor, temporaryPath
+
+
+class APITest(TestCase):
+  def setUp(self):
+    self.patch(database, "reactor", ManualReactor())
+    self.patch(icons, "reactor", ManualReactor())  # icons are never processed here, the pool isn't started
+    self.database = Database(temporaryPath(self, "konnect.db"))
+    self.database._start()
+    self.addCleanup(self.database._stop)
+    self.konnect = KonnectFactory(self.database, "server", "tests", None)
+    self.api = API(self.konnect, None, TransferFactory(None), self.database, False)
+    self.site = Site(self.api, timeout=None)
+    self.site.protocol = HTTPChannel  # plain http/1.1, its pending requests can be waited on
+
+  def request(self, method, uri, data=None, headers=None):  # (code, headers, body) over a real http channel
+    transport = StringTransport()
+    channel = self.site.buildProtocol(None)
+    channel.makeConnection(transport)
+    body = dumps(data).encode() if data is not None else b""
+    lines = [f"{method} {uri} HTTP/1.1", "Host: localhost", f"Content-Length: {len(body)}",
+             *(f"{name}: {value}" for name, value in (headers or {}).items())]
+    channel.dataReceived("\r\n".join(lines).encode() + b"\r\n\r\n" + body)
+
+    return gatherResults([request.notifyFinish() for request in channel.requests]).addCallback(
+      lambda _: self.parse(transport.value()))
+
+  @staticmethod
+  def parse(response):
+    head, _, body = response.partition(b"\r\n\r\n")
+    status, *lines = head.decode().split("\r\n")
+    headers = {name.lower(): value for name, _, value in (line.partition(": ") for line in lines)}
+
+    return int(status.split(" ")[1]), headers, loads(body) if body else None
+
+  @inlineCallbacks
+  def pair(self, identifier, name, connected=False):
+    client = FakeClient(identifier, name)
+    self.konnect.registerClient(client)
+    yield self.konnect.pairDevice(client, "certificate")
+
+    if not connected:
+      self.konnect.unregisterClient(client)
+
+  @inlineCallbacks
+  def testStaticRoute(self):
+    code, _, body = yield self.request("GET", "/version")
+
+    self.assertEqual(code, 200)
+    self.assertTrue(body["success"])
+
+  @inlineCallbacks
+  def testUnknownRoute(self):
+    for method, uri in [("GET", "/nowhere"), ("GET", "/version/extra"), ("POST", "/device"), ("POST", "/ping")]:
+      code, _, _ = yield self.request(method, uri)
+      self.assertEqual(code, 501, uri)
+
+  @inlineCallbacks
+  def testDeviceRoute(self):
+    yield self.pair("phone", "My Phone")
+
+    code, _, body = yield self.request("GET", "/device/@my%20phone")
+    self.assertEqual((code, body["identifier"]), (200, "phone"))
+
+    code, _, body = yield self.request("GET", "/device/other")
+    self.assertEqual((code, body["message"]), (401, "device not paired"))
+
+    code, _, body = yield self.request("POST", "/ping/phone")
+    self.assertEqual((code, body["message"]), (404, "device not reachable"))
+
+  @inlineCallbacks
+  def testKeyedRoute(self):
+    yield self.pair("phone", "Phone")
+
+    code, _, body = yield self.request("POST", "/command/phone", {"name": "Uptime", "command": "uptime"})
+    self.assertEqual(code, 201)
+
+    code, _, _ = yield self.request("PUT", f"/command/phone/{body['key']}", {"name": "Load", "command": "w"})
+    self.assertEqual(code, 200)
+
+    code, _, body = yield self.request("GET", "/command/phone")
+    self.assertEqual([command["name"] for command in body["commands"]], ["Load"])
+
+  @inlineCallbacks
+  def testQueryString(self):
+    code, _, _ = yield self.request("PUT", "/trace?route=/device&duration=60")
+    self.assertEqual(code, 200)
+
+    code, _, body = yield self.request("DELETE", "/trace?route=/device", {"route": "/command"})
+    self.assertEqual((code, body["message"]), (404, "trace not found"))  # the body wins
+
+    code, _, _ = yield self.request("DELETE", "/trace?route=/device")
+    self.assertEqual(code, 200)
+
+  @inlineCallbacks
+  def testInvalidBody(self):
+    code, _, body = yield self.request("PUT", "/trace", headers={"Content-Type": "application/json"})
+    self.assertEqual(code, 400)
+
+    transport = StringTransport()
+    channel = self.site.buildProtocol(None)
+    channel.makeConnection(transport)
+    channel.dataReceived(b"PUT /trace HTTP/1.1\r\nHost: localhost\r\nContent-Length: 3\r\n\r\n{x}")
+
+    code, _, body = self.parse(transport.value())
+    self.assertEqual((code, body["message"]), (400, "unserialization error"))
+
+  @inlineCallbacks
+  def testNotModified(self):
+    code, headers, body = yield self.request("GET", "/device")
+    etag = headers["etag"]
+    self.assertEqual((code, body["devices"]), (200, []))
+
+    code, headers, body = yield self.request("GET", "/device", headers={"If-None-Match": etag})
+    self.assertEqual((code, headers["etag"], body), (304, etag, None))
+
+    yield self.pair("phone", "Phone")
+
+    code, headers, body = yield self.request("GET", "/device", headers={"If-None-Match": etag})
+    self.assertEqual((code, len(body["devices"])), (200, 1))
+    self.assertNotEqual(headers["etag"], etag)
+
+  @inlineCallbacks
+  def testCachedBody(self):
+    yield self.pair("phone", "Phone")
+
+    code, headers, first = yield self.request("GET", "/notification")
+    self.assertEqual((code, first["notifications"]), (200, []))
+
+    code, _, second = yield self.request("GET", "/notification")
+    self.assertEqual((code, second), (200, first))
+    self.assertEqual(self.api.bodies["/notification"][0].decode(), headers["etag"])
+
+    yield self.request("POST", "/notification/phone", {"text": "text", "title": "title", "application": "tests"})
+
+    code, changed, body = yield self.request("GET", "/notification", headers={"If-None-Match": headers["etag"]})
+    self.assertEqual((code, len(body["notifications"])), (200, 1))
+    self.assertNotEqual(changed["etag"], headers["etag"])
+
+  @inlineCallbacks
+  def testErrorsNotCached(self):
+    self.patch(self.database, "listAllCommands", lambda: self.fail("read while cached"))
+    self.patch(self.api, "routes", {**self.api.routes, ("GET", "/command"): lambda data: ({}, 503)})
+
+    code, _, _ = yield self.request("GET", "/command")
+    self.assertEqual(code, 503)
+    self.assertNotIn("/command", self.api.bodies)
+
+  @inlineCallbacks
+  def testBatchInvalidIcon(self):
+    yield self.pair("phone", "Phone")
+    notification = {"text": "text", "title": "title", "application": "tests", "icon": ["a.png"]}
+
+    code, _, body = yield self.request("POST", "/notification", {"notifications": [notification], "devices": "*"})
+    self.assertEqual((code, body["message"]), (400, "icon invalid"))
+
+  @inlineCallbacks
+  def testBatchTargetsOnce(self):
+    client = FakeClient("phone", "Phone")
+    sent = []
+    client.sendNotification = lambda text, title, application, reference, payload: sent.append(reference)
+    self.konnect.registerClient(client)
+    yield self.konnect.pairDevice(client, "certificate")
+    notification = {"text": "text", "title": "title", "application": "tests", "reference": "a"}
+
+    code, _, body = yield self.request("POST", "/notification", {"notifications": [notification],
+                                                                 "devices": ["phone", "@phone", "phone", "x", "x"]})
+    self.assertEqual(code, 201)
+    self.assertEqual([(result["device"], result["success"]) for result in body["results"]],
+                     [("phone", True), ("x", False)])
+    self.assertEqual(sent, ["a"])
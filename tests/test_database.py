@@ -0,0 +1,73 @@
+from sqlite3 import OperationalError
+
+from twisted.internet.defer import fail, inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from konnect import database
+from konnect.database import Database
+from tests.helpers import ManualReactor, temporaryPath
+
+
+class DatabaseTest(TestCase):
+  def setUp(self):
+    self.patch(database, "reactor", ManualReactor())
+    self.database = Database(temporaryPath(self, "konnect.db"))
+    self.database._start()
+    self.addCleanup(self.database._stop)
+
+  @inlineCallbacks
+  def testReadAfterWrite(self):
+    self.database.pairDevice("phone", "certificate", "Phone", "phone")
+    self.database.persistNotification("phone", "text", "title", "application", "reference")
+    deferred = self.database.listNotifications("phone")
+
+    self.assertEqual(len(self.database.barriers), 1)
+
+    rows = yield deferred
+
+    self.assertEqual([row["reference"] for row in rows], ["reference"])
+    self.assertEqual(self.database.committed, self.database.queued)
+    self.assertEqual(len(self.database.barriers), 0)
+
+  @inlineCallbacks
+  def testReadWithoutWrites(self):
+    yield self.database.pairDevice("phone", "certificate", "Phone", "phone")
+    deferred = self.database.listCommands("phone")
+
+    self.assertEqual(len(self.database.barriers), 0)
+    self.assertEqual((yield deferred), [])
+
+  @inlineCallbacks
+  def testOrderedBarriers(self):
+    self.database.pairDevice("phone", "certificate", "Phone", "phone")
+    self.database.addCommand("phone", "first", "First", "true")
+    first = self.database.listCommands("phone")
+    self.database.addCommand("phone", "second", "Second", "true")
+    second = self.database.listCommands("phone")
+
+    self.assertEqual([sequence for sequence, _ in self.database.barriers], [2, 3])
+    self.assertIn("first", [row["key"] for row in (yield first)])  # later writes may be visible too
+    self.assertEqual([row["key"] for row in (yield second)], ["first", "second"])
+
+  @inlineCallbacks
+  def testFailedWriteReleasesReads(self):
+    failed = self.database._write("INSERT INTO missing VALUES (?)", (1,))
+    deferred = self.database.listAllCommands()
+
+    yield self.assertFailure(failed, OperationalError)
+    self.assertEqual((yield deferred), [])
+
+  @inlineCallbacks
+  def testFailedPairReverted(self):
+    self.patch(self.database, "_write", lambda query, params: fail(OperationalError("disk I/O error")))
+
+    yield self.assertFailure(self.database.pairDevice("phone", "certificate", "Phone", "phone"), OperationalError)
+    self.assertFalse(self.database.isDeviceTrusted("phone"))
+
+  @inlineCallbacks
+  def testFailedUnpairReverted(self):
+    yield self.database.pairDevice("phone", "certificate", "Phone", "phone")
+    self.patch(self.database, "_write", lambda query, params: fail(OperationalError("disk I/O error")))
+
+    yield self.assertFailure(self.database.unpairDevice("phone"), OperationalError)
+    self.assertTrue(self.database.isDeviceTrusted("phone"))
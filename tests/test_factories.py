@@ -0,0 +1,244 @@
+from sqlite3 import OperationalError
+
+from twisted.internet.defer import fail, inlineCallbacks
+from twisted.internet.error import CannotListenError
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from konnect import database, factories
+from konnect.database import Database
+from konnect.factories import MIN_XFER_PORT, PAYLOAD_TIMEOUT, KonnectFactory, TransferFactory
+from tests.helpers import FakeClient, ManualReactor, temporaryPath
+
+
+class KonnectFactoryTest(TestCase):
+  def setUp(self):
+    self.patch(database, "reactor", ManualReactor())
+    self.database = Database(temporaryPath(self, "konnect.db"))
+    self.database._start()
+    self.addCleanup(self.database._stop)
+    self.konnect = KonnectFactory(self.database, "server", "tests", None)
+
+  def assertConsistent(self):
+    self.assertEqual(self.konnect.checkConsistency(), [])
+
+  @inlineCallbacks
+  def pair(self, client):
+    self.konnect.registerClient(client)
+    yield self.konnect.pairDevice(client, "certificate")
+
+  @inlineCallbacks
+  def testPair(self):
+    client = FakeClient("phone", "Phone")
+    self.konnect.registerClient(client)
+    self.assertConsistent()
+
+    yield self.konnect.pairDevice(client, "certificate")
+    self.assertConsistent()
+    self.assertTrue(self.konnect.getDevice("phone")["trusted"])
+
+  @inlineCallbacks
+  def testUnpairConnected(self):
+    client = FakeClient("phone", "Phone")
+    yield self.pair(client)
+    yield self.konnect.unpairDevice("phone")
+
+    self.assertConsistent()
+    self.assertEqual(self.konnect.getDevice("phone")["trusted"], False)
+
+    self.konnect.unregisterClient(client)
+    self.assertConsistent()
+    self.assertIsNone(self.konnect.getDevice("phone"))
+
+  @inlineCallbacks
+  def testUnpairOffline(self):
+    client = FakeClient("phone", "Phone")
+    yield self.pair(client)
+    self.konnect.unregisterClient(client)
+    self.assertConsistent()
+
+    yield self.konnect.unpairDevice("phone")
+    self.assertConsistent()
+    self.assertEqual(self.konnect.getDevices(), [])
+
+  @inlineCallbacks
+  def testReconnect(self):
+    first = FakeClient("phone", "Phone")
+    yield self.pair(first)
+    self.konnect.unregisterClient(first)
+    self.assertConsistent()
+    self.assertEqual(self.konnect.getDevice("phone")["reachable"], False)
+
+    second = FakeClient("phone", "Phone")
+    self.konnect.registerClient(second)
+    self.assertConsistent()
+
+    third = FakeClient("phone", "Renamed")  # connects before the previous connection is lost
+    self.konnect.registerClient(third)
+    self.konnect.unregisterClient(second)
+    yield self.konnect.updateDevice(third)
+
+    self.assertConsistent()
+    self.assertIs(self.konnect.findClient("phone"), third)
+    self.assertEqual(self.konnect.getDevice("phone")["name"], "Renamed")
+
+  def testUntrustedReconnect(self):
+    first = FakeClient("phone", "Phone")
+    second = FakeClient("phone", "Phone")
+    self.konnect.registerClient(first)
+    self.konnect.registerClient(second)
+    self.konnect.unregisterClient(first)
+    self.assertConsistent()
+
+    self.konnect.unregisterClient(second)
+    self.assertConsistent()
+    self.assertEqual(self.konnect.getDevices(), [])
+
+  @inlineCallbacks
+  def testUpdateCommands(self):
+    stale = FakeClient("phone", "Phone")
+    client = FakeClient("phone", "Phone")
+    yield self.pair(stale)
+    self.konnect.registerClient(client)
+
+    client.commands = {"uptime": {"name": "Uptime", "command": "uptime"}}
+    self.konnect.updateCommands(client)
+    stale.commands = {"stale": {"name": "Stale", "command": "true"}}
+    self.konnect.updateCommands(stale)
+
+    self.assertConsistent()
+    self.assertEqual(self.konnect.getDevice("phone")["commands"], client.commands)
+
+    self.konnect.unregisterClient(client)
+    self.assertConsistent()
+    self.assertEqual(self.konnect.getDevice("phone")["commands"], {})
+
+  @inlineCallbacks
+  def testSetPath(self):
+    client = FakeClient("phone", "Phone")
+    yield self.pair(client)
+
+    yield self.konnect.setPath("phone", "/tmp")
+    self.assertConsistent()
+    self.assertEqual(self.konnect.getPath("phone"), "/tmp")
+    self.assertEqual((yield self.database.getPath("phone")), "/tmp")
+
+    yield self.konnect.setPath("phone")
+    self.assertConsistent()
+    self.assertIsNone(self.konnect.getPath("phone"))
+
+  @inlineCallbacks
+  def testRestart(self):
+    client = FakeClient("phone", "Phone")
+    yield self.pair(client)
+    yield self.konnect.setPath("phone", "/tmp")
+
+    restarted = KonnectFactory(self.database, "server", "tests", None)
+
+    self.assertEqual(restarted.checkConsistency(), [])
+    self.assertEqual(restarted.getDevice("phone")["path"], "/tmp")
+
+  @inlineCallbacks
+  def testFailedPair(self):
+    client = FakeClient("phone", "Phone")
+    self.konnect.registerClient(client)
+    self.patch(self.database, "_write", lambda query, params: fail(OperationalError("disk I/O error")))
+
+    yield self.assertFailure(self.konnect.pairDevice(client, "certificate"), OperationalError)
+    self.assertConsistent()
+    self.assertFalse(self.konnect.isDeviceTrusted("phone"))
+    self.assertEqual(self.konnect.getDevice("phone")["trusted"], False)
+
+  @inlineCallbacks
+  def testFailedUnpair(self):
+    client = FakeClient("phone", "Phone")
+    yield self.pair(client)
+    yield self.konnect.setPath("phone", "/tmp")
+    self.patch(self.database, "_write", lambda query, params: fail(OperationalError("disk I/O error")))
+
+    yield self.assertFailure(self.konnect.unpairDevice("phone"), OperationalError)
+    self.assertConsistent()
+    self.assertEqual(self.konnect.getDevice("phone")["path"], "/tmp")
+    self.assertTrue(self.konnect.getDevice("phone")["reachable"])
+
+  @inlineCallbacks
+  def testInconsistent(self):
+    client = FakeClient("phone", "Phone")
+    yield self.pair(client)
+    self.konnect.devices["phone"] = {**self.konnect.devices["phone"], "name": "Stale", "reachable": False}
+
+    self.assertEqual(self.konnect.checkConsistency(), ["phone: name differs from database",
+                                                       "phone: connected but not reachable"])
+
+    self.konnect.unregisterClient(client)
+    self.konnect.devices["phone"] = {**self.konnect.devices["phone"], "name": "Phone", "reachable": True}
+
+    self.assertEqual(self.konnect.checkConsistency(), ["phone: reachable but not connected"])
+
+
+class TransferFactoryTest(TestCase):
+  def setUp(self):
+    self.clock = Clock()
+    self.patch(factories, "reactor", self.clock)
+    self.transfers = TransferFactory(None)
+    self.transfers.listeners = {MIN_XFER_PORT: None, MIN_XFER_PORT + 1: None}
+
+  def testPoolSize(self):
+    def listenSSL(port, factory, options, interface):
+      if port == MIN_XFER_PORT:  # taken by another program
+        raise CannotListenError(interface, port, None)
+
+      return port
+
+    self.clock.listenSSL = listenSSL
+    transfers = TransferFactory(None, count=3)
+    transfers.startListening()
+
+    self.assertEqual(list(transfers.listeners), [MIN_XFER_PORT + 1, MIN_XFER_PORT + 2, MIN_XFER_PORT + 3])
+
+  def testAdd(self):
+    first = self.transfers.addPayload("10.0.0.2", "/tmp/a", "a", 10)
+    again = self.transfers.addPayload("10.0.0.2", "/tmp/a", "a", 10)
+    other = self.transfers.addPayload("10.0.0.3", "/tmp/a", "a", 10)
+    second = self.transfers.addPayload("10.0.0.2", "/tmp/b", "b", 20)
+
+    self.assertEqual(first, MIN_XFER_PORT)
+    self.assertEqual(again, first)
+    self.assertEqual(other, MIN_XFER_PORT)
+    self.assertEqual(second, MIN_XFER_PORT + 1)
+    self.assertEqual(self.transfers.payloads[(first, "10.0.0.2")]["claims"], 2)
+    self.assertEqual(self.transfers.getStats(), {"ports": 2, "pending": 4, "served": 0, "expired": 0})
+
+  def testAddWithoutPorts(self):
+    self.transfers.addPayload("10.0.0.2", "/tmp/a", "a", 10)
+    self.transfers.addPayload("10.0.0.2", "/tmp/b", "b", 10)
+
+    self.assertIsNone(self.transfers.addPayload("10.0.0.2", "/tmp/c", "c", 10))
+
+  def testClaim(self):
+    port = self.transfers.addPayload("10.0.0.2", "/tmp/a", "a", 10)
+    self.transfers.addPayload("10.0.0.2", "/tmp/a", "a", 10)
+
+    self.assertIsNone(self.transfers.claimPayload(port, "10.0.0.3"))
+    self.assertEqual(self.transfers.claimPayload(port, "10.0.0.2")["path"], "/tmp/a")
+    self.assertIn((port, "10.0.0.2"), self.transfers.payloads)
+    self.assertEqual(self.transfers.claimPayload(port, "10.0.0.2")["digest"], "a")
+    self.assertEqual(self.transfers.payloads, {})
+    self.assertEqual(self.transfers.digests, {})
+    self.assertEqual(self.clock.getDelayedCalls(), [])
+    self.assertEqual(self.transfers.getStats()["served"], 2)
+
+  def testExpire(self):
+    port = self.transfers.addPayload("10.0.0.2", "/tmp/a", "a", 10)
+    self.clock.advance(PAYLOAD_TIMEOUT - 1)
+    self.transfers.addPayload("10.0.0.2", "/tmp/a", "a", 10)  # a new claim restarts the timeout
+    self.clock.advance(PAYLOAD_TIMEOUT - 1)
+
+    self.assertIn((port, "10.0.0.2"), self.transfers.payloads)
+
+    self.clock.advance(1)
+
+    self.assertEqual(self.transfers.payloads, {})
+    self.assertIsNone(self.transfers.claimPayload(port, "10.0.0.2"))
+    self.assertEqual(self.transfers.getStats(), {"ports": 2, "pending": 0, "served": 0, "expired": 2})
+    self.assertEqual(self.transfers.addPayload("10.0.0.2", "/tmp/a", "a", 10), port)
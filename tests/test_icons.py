@@ -0,0 +1,144 @@
+from os import listdir, remove, utime
+from os.path import isfile, join
+
+from PIL import Image
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from konnect import icons
+from konnect.exceptions import ServiceUnavailableError
+from konnect.icons import MAX_ICON_SIZE, IconCache, IconProcessor
+from tests.helpers import ManualReactor, temporaryPath
+
+
+class IconProcessorTest(TestCase):
+  def setUp(self):
+    self.patch(icons, "reactor", ManualReactor())
+    self.temp_dir = temporaryPath(self)
+
+  def createProcessor(self, **kwargs):
+    processor = IconProcessor(temporaryPath(self), **kwargs)
+    processor.pool.start()
+    self.addCleanup(processor.pool.stop)
+
+    return processor
+
+  def createIcon(self, name, size):
+    path = join(self.temp_dir, name)
+    Image.new("RGB", size).save(path)
+
+    return path
+
+  @inlineCallbacks
+  def testThumbnail(self):
+    processor = self.createProcessor()
+    item = yield processor.process(self.createIcon("large.jpg", (200, 100)))
+
+    self.assertTrue(isfile(item["path"]))
+
+    with Image.open(item["path"]) as image:
+      self.assertEqual((image.format, image.size), ("PNG", (MAX_ICON_SIZE, MAX_ICON_SIZE // 2)))
+
+  @inlineCallbacks
+  def testSameIconOnce(self):
+    processor = self.createProcessor()
+    icon = self.createIcon("icon.png", (16, 16))
+    first = processor.process(icon)
+    second = processor.process(icon)
+
+    self.assertEqual(processor.queued, 1)
+    self.assertEqual((yield first), (yield second))
+    self.assertEqual(processor.cache.getStats()["entries"], 1)
+
+  @inlineCallbacks
+  def testQueueFull(self):
+    processor = self.createProcessor(queue_size=1)
+    deferred = processor.process(self.createIcon("a.png", (16, 16)))
+
+    self.assertRaises(ServiceUnavailableError, processor.process, self.createIcon("b.png", (16, 16)))
+
+    yield deferred
+    self.assertEqual(processor.queued, 0)
+
+
+class IconCacheTest(TestCase):
+  def setUp(self):
+    self.temp_dir = temporaryPath(self)
+
+  def createItem(self, digest, size=10):
+    path = join(self.temp_dir, digest)
+
+    with open(path, "wb") as output:
+      output.write(b"\0" * size)
+
+    return {"path": path, "digest": digest, "size": size}
+
+  def testHitAndMiss(self):
+    cache = IconCache(self.temp_dir)
+    item = self.createItem("a")
+    cache.put(("a.png", 1, 100), item)
+
+    self.assertEqual(cache.get(("a.png", 1, 100)), item)
+    self.assertIsNone(cache.get(("a.png", 2, 100)))  # modified since
+    self.assertEqual(cache.getStats(), {"entries": 1, "files": 1, "size": 10, "hits": 1, "misses": 1,
+                                        "evictions": 0})
+
+  def testLeastRecentlyUsed(self):
+    cache = IconCache(self.temp_dir, max_entries=2)
+    cache.put("a", self.createItem("a"))
+    cache.put("b", self.createItem("b"))
+    cache.get("a")
+    cache.put("c", self.createItem("c"))
+
+    self.assertEqual(list(cache.index), ["a", "c"])
+    self.assertIsNone(cache.get("b"))
+    self.assertEqual(cache.files["b"]["refs"], 0)  # kept on disk until the size limit needs it
+
+  def testSharedFile(self):
+    cache = IconCache(self.temp_dir)
+    item = self.createItem("a")
+    cache.put("a.png", item)
+    cache.put("copy.png", dict(item))
+
+    self.assertEqual(cache.files["a"], {"size": 10, "refs": 2})
+    self.assertEqual(cache.size, 10)
+
+  def testSizeEviction(self):
+    cache = IconCache(self.temp_dir, max_size=25)
+    cache.put("a", self.createItem("a"))
+    cache.put("b", self.createItem("b"))
+    cache.get("a")
+    cache.put("c", self.createItem("c"))
+
+    self.assertEqual(list(cache.index), ["a", "c"])
+    self.assertEqual(sorted(listdir(self.temp_dir)), ["a", "c"])
+    self.assertEqual(cache.size, 20)
+    self.assertEqual(cache.evictions, 1)
+
+  def testOrphansFirst(self):
+    cache = IconCache(self.temp_dir, max_entries=1, max_size=25)
+    cache.put("a", self.createItem("a"))
+    cache.put("b", self.createItem("b"))  # a is no longer indexed but still on disk
+    cache.put("c", self.createItem("c"))
+
+    self.assertEqual(list(cache.index), ["c"])
+    self.assertEqual(sorted(listdir(self.temp_dir)), ["b", "c"])
+
+  def testMissingFile(self):
+    cache = IconCache(self.temp_dir)
+    item = self.createItem("a")
+    cache.put("a", item)
+    remove(item["path"])
+
+    self.assertIsNone(cache.get("a"))
+    self.assertEqual(cache.files["a"]["refs"], 0)
+
+  def testStartup(self):
+    for index, digest in enumerate(["old", "new"]):
+      item = self.createItem(digest)
+      utime(item["path"], (index, index))
+
+    cache = IconCache(self.temp_dir, max_size=15)
+
+    self.assertEqual(listdir(self.temp_dir), ["new"])
+    self.assertEqual(cache.getStats()["files"], 1)
@@ -0,0 +1,216 @@
+from json import dumps
+from os.path import join
+from types import SimpleNamespace
+
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+from twisted.trial.unittest import TestCase
+
+from konnect import protocols
+from konnect.logs import Tracer
+from konnect.metrics import PACKETS
+from konnect.protocols import BULK, CHUNK_SIZE, CONTROL, DROP, INTERACTIVE, MERGE, REPLAY_DELAY, TRANSFER_TIMEOUT, \
+  Konnect, PacketQueue, ShareSend
+from tests.helpers import temporaryPath
+
+
+class PacketQueueTest(TestCase):
+  def createQueue(self, limit=1024, policy=MERGE):
+    self.transport = StringTransport()
+    self.written = []
+    self.dropped = []
+    queue = PacketQueue(self.transport, limit, policy, self.written.append, self.dropped.append)
+    queue.pauseProducing()  # nothing is scheduled, resumeProducing() flushes in place
+
+    return queue
+
+  def testPriority(self):
+    queue = self.createQueue()
+    queue.push(BULK, b"bulk\n")
+    queue.push(INTERACTIVE, b"interactive\n")
+    queue.push(CONTROL, b"control\n")
+    queue.resumeProducing()
+
+    self.assertEqual(self.transport.value(), b"control\ninteractive\nbulk\n")
+    self.assertEqual(queue.getStats(), {"bytes": 0, "packets": 0, "sent": 3, "dropped": 0, "merged": 0})
+
+  def testWritten(self):
+    queue = self.createQueue()
+    queue.push(BULK, b"a" * 10, ("notification", "1"), "1")
+    queue.push(INTERACTIVE, b"b" * 10)
+
+    self.assertEqual(self.written, [])
+
+    queue.resumeProducing()
+
+    self.assertEqual(self.written, ["1"])
+
+  def testMergeOnOverflow(self):
+    queue = self.createQueue(30)
+    queue.push(BULK, b"a" * 10, ("notification", "1"), "1a")
+    queue.push(BULK, b"b" * 10, ("notification", "2"), "2")
+    queue.push(BULK, b"c" * 10, ("notification", "3"))
+    queue.push(BULK, b"A" * 10, ("notification", "1"), "1b")
+    queue.resumeProducing()
+
+    self.assertEqual(self.transport.value(), b"A" * 10 + b"b" * 10 + b"c" * 10)
+    self.assertEqual(self.written, ["1b", "2"])
+    self.assertEqual(self.dropped, [])
+    self.assertEqual(queue.getStats()["merged"], 1)
+
+  def testMergeOnlyOnOverflow(self):
+    queue = self.createQueue()
+    queue.push(BULK, b"a" * 10, ("notification", "1"))
+    queue.push(BULK, b"A" * 10, ("notification", "1"))
+    queue.resumeProducing()
+
+    self.assertEqual(self.transport.value(), b"a" * 10 + b"A" * 10)
+    self.assertEqual(queue.getStats()["merged"], 0)
+
+  def testMergeFallsBackToDrop(self):
+    queue = self.createQueue(20)
+    queue.push(BULK, b"a" * 10, ("notification", "1"), "1")
+    queue.push(BULK, b"b" * 10, ("notification", "2"), "2")
+    queue.push(BULK, b"c" * 10, ("notification", "3"), "3")
+    queue.resumeProducing()
+
+    self.assertEqual(self.transport.value(), b"b" * 10 + b"c" * 10)
+    self.assertEqual(self.dropped, ["1"])
+    self.assertEqual(self.written, ["2", "3"])
+
+  def testDropPolicy(self):
+    queue = self.createQueue(30, DROP)
+    queue.push(BULK, b"a" * 10, ("notification", "1"), "1a")
+    queue.push(BULK, b"b" * 10, ("notification", "2"), "2")
+    queue.push(BULK, b"c" * 10, ("notification", "3"))
+    queue.push(BULK, b"A" * 10, ("notification", "1"), "1b")
+    queue.resumeProducing()
+
+    self.assertEqual(self.transport.value(), b"b" * 10 + b"c" * 10 + b"A" * 10)
+    self.assertEqual(self.dropped, ["1a"])
+    self.assertEqual(queue.getStats()["merged"], 0)
+
+  def testDropOrder(self):
+    queue = self.createQueue(20)
+    queue.push(BULK, b"a" * 10)
+    queue.push(INTERACTIVE, b"b" * 10)
+    queue.push(CONTROL, b"c" * 10)
+
+    self.assertEqual(queue.getStats()["dropped"], 1)
+
+    queue.push(INTERACTIVE, b"d" * 10)
+    queue.resumeProducing()
+
+    self.assertEqual(self.transport.value(), b"c" * 10 + b"d" * 10)
+    self.assertEqual(queue.getStats()["dropped"], 2)
+
+  def testUrgentEntriesKept(self):
+    queue = self.createQueue(20)
+    queue.push(CONTROL, b"a" * 10)
+    queue.push(INTERACTIVE, b"b" * 10)
+    queue.push(BULK, b"c" * 5, ("notification", "1"), "1")
+    queue.resumeProducing()
+
+    self.assertEqual(self.transport.value(), b"a" * 10 + b"b" * 10)
+    self.assertEqual(self.dropped, ["1"])
+    self.assertEqual(self.written, [])
+
+  def testPushedEntryKept(self):
+    queue = self.createQueue(10)
+    queue.push(BULK, b"a" * 10)
+    queue.push(INTERACTIVE, b"b" * 15)
+    queue.resumeProducing()
+
+    self.assertEqual(self.transport.value(), b"b" * 15)
+
+  def testStopProducing(self):
+    queue = self.createQueue()
+    queue.push(BULK, b"a" * 10, ("notification", "1"), "1")
+    queue.push(CONTROL, b"b" * 10)
+    queue.stopProducing()
+
+    self.assertEqual(self.transport.value(), b"")
+    self.assertEqual(self.written, [])
+    self.assertEqual(self.dropped, ["1"])
+    self.assertEqual(queue.getStats(), {"bytes": 0, "packets": 0, "sent": 0, "dropped": 2, "merged": 0})
+
+
+class KonnectTest(TestCase):
+  def createClient(self):
+    self.clock = Clock()
+    self.patch(protocols, "callLater", self.clock.callLater)
+    self.dismissed = []
+    client = Konnect()
+    client.identifier = "phone"
+    client.factory = SimpleNamespace(tracer=Tracer(), delivered={"phone": {"a": ("text", "title", "app")}})
+    client.database = SimpleNamespace(dismissNotification=lambda identifier, reference: self.dismissed.append(reference))
+    client.transport = StringTransport()
+    client.queue = PacketQueue(client.transport, written=client._written, dropped=client._dropped)
+
+    return client
+
+  def testReplayedCancelDismissed(self):
+    client = self.createClient()
+    client._replayNotifications([{"cancel": 1, "reference": "a", "text": "text", "title": "title",
+                                  "application": "app"}])
+
+    self.assertEqual(self.dismissed, [])
+
+    self.clock.advance(REPLAY_DELAY)
+    self.clock.advance(0)
+
+    self.assertIn(b'"isCancel":true', client.transport.value())
+    self.assertEqual(self.dismissed, ["a"])
+    self.assertEqual(client.factory.delivered["phone"], {})
+
+  def testLostCancelKept(self):
+    client = self.createClient()
+    client._replayNotifications([{"cancel": 1, "reference": "a", "text": "text", "title": "title",
+                                  "application": "app"}])
+    client._cancelReplay()  # the connection is lost before the cancel is written
+    self.clock.advance(REPLAY_DELAY)
+
+    self.assertEqual(client.transport.value(), b"")
+    self.assertEqual(self.dismissed, [])
+
+  def testUnidentifiedPacketsNotCounted(self):
+    client = Konnect()
+    client.factory = SimpleNamespace(tracer=Tracer())
+    client.transport = StringTransport()
+    client.transport.TLS = False
+    self.patch(PACKETS, "values", {})
+
+    for index in range(10):
+      client.lineReceived(dumps({"id": index, "type": f"spoofed.{index}", "body": {}}).encode())
+
+    self.assertEqual(PACKETS.values, {})
+
+
+class ShareSendTest(TestCase):
+  def setUp(self):
+    self.clock = Clock()
+    self.path = join(temporaryPath(self), "payload")
+
+    with open(self.path, "wb") as output:
+      output.write(b"\0" * CHUNK_SIZE * 3)
+
+    payload = {"path": self.path, "digest": "a", "size": CHUNK_SIZE * 3}
+    self.sender = ShareSend()
+    self.sender.callLater = self.clock.callLater
+    self.sender.factory = SimpleNamespace(claimPayload=lambda port, host: payload)
+    self.transport = StringTransport()
+    self.sender.makeConnection(self.transport)
+    self.addCleanup(self.sender.connectionLost, None)
+
+  def testStalledTransfer(self):
+    self.transport.producer.resumeProducing()
+    self.clock.advance(TRANSFER_TIMEOUT - 1)
+    self.transport.producer.resumeProducing()  # still reading, the timeout restarts
+    self.clock.advance(TRANSFER_TIMEOUT - 1)
+
+    self.assertFalse(self.transport.disconnecting)
+
+    self.clock.advance(1)
+
+    self.assertTrue(self.transport.disconnecting)
+    self.assertEqual(len(self.transport.value()), CHUNK_SIZE * 2)